@@ -0,0 +1,62 @@
+import numpy as np
+
+def AdaptiveSampling(f, x, tol=1e-3, seed=(), N_init=33):
+    """ sample function on grid adaptively so that
+    error of linear interpolation is less than tolerance
+    f: function
+      f(k) returns float array of shape (..., len(k))
+      for int 1d-array k (indices of grid points
+      in increasing order)
+    x: float, 1d-array
+      grid points in increasing order (len(x) >= 2)
+    tol: float, scalar
+      tolerance of interpolation error relative to max|f|
+      (maximum over grid for each leading index of f)
+    seed: float, 1d-array
+      grid points nearest to seed are sampled initially
+      in addition to uniform subgrid
+      (e.g. rainbow angles theta_r)
+    N_init: int, scalar
+      number of points of initial uniform subgrid
+    return: I
+      I: float, shape (..., len(x))
+        f at all grid points, where f is sampled
+        and linearly interpolated elsewhere
+    comment: in each step, f is evaluated at midpoints of
+      intervals not yet converged (in one call), and interval
+      is bisected unless |f(midpoint) - interpolation| <= tol*max|f|
+      for both the interval and its parent (to avoid missing
+      narrow features), until interval has no grid points inside
+    """
+    N = len(x)
+    seed = np.ravel(seed)
+    seed = seed[(seed >= x[0]) & (seed <= x[-1])]
+    seed = np.searchsorted(x, seed)
+    k = np.linspace(0, N-1, min(N, N_init)).astype(int)
+    k = np.unique(np.r_[k, seed])
+    I = f(k)
+    s = np.max(np.abs(I), axis=-1, keepdims=True)
+    i = np.arange(len(k)-1) # left ends of intervals to be checked
+    p = np.zeros(len(i), dtype=bool) # whether parent is converged
+
+    while True:
+        j = k[i+1] - k[i] > 1
+        i,p = i[j], p[j]
+        if len(i)==0: break
+        m = (k[i] + k[i+1])//2
+        J = f(m)
+        s = np.maximum(s, np.max(np.abs(J), axis=-1, keepdims=True))
+        w = (x[m] - x[k[i]])/(x[k[i+1]] - x[k[i]])
+        d = np.abs(J - I[...,i]*(1-w) - I[...,i+1]*w)/np.where(s, s, 1)
+        d = np.max(np.reshape(d, (-1, len(i))), axis=0) <= tol
+        k = np.insert(k, i+1, m)
+        I = np.insert(I, i+1, J, axis=-1)
+        j = ~(d & p) # not converged twice in a row
+        i = i[j] + np.arange(len(i))[j] # index after insertion
+        i = np.ravel(np.c_[i, i+1])
+        p = np.repeat(d[j], 2)
+
+    j = np.searchsorted(k, np.arange(N), 'right') - 1
+    j = np.clip(j, 0, len(k)-2)
+    w = (x - x[k[j]])/(x[k[j+1]] - x[k[j]])
+    return I[...,j]*(1-w) + I[...,j+1]*w
@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.special import airy
 from Rainbow import Rainbow
+from Counters import clock, record
 
 class AiryRainbow(Rainbow):
     """ Airy theory of diffraction
@@ -12,10 +13,12 @@ class AiryRainbow(Rainbow):
     """
     def __init__(self, m, x):
         """
-        m: float, scalar
+        m: float, scalar or array
           refractive index of raindrop
-        x: float, scalar
+        x: float, scalar or array
           2pi*(radius of raindrop)/(wavelength of light)
+          if m or x is array, intensity is broadcast over
+          m, x and theta (see RainbowBatch.py)
         """
         super().__init__(m)
         self.x = x
@@ -43,6 +46,7 @@ class AiryRainbow(Rainbow):
         elif order==2: a = 8/9
         else: raise RuntimeError("bad order")
 
+        t0 = clock()
         j = order - 1
         alpha = self.alpha_r[j] # rainbow angle
         beta = self.beta_r[j]
@@ -71,4 +75,6 @@ class AiryRainbow(Rainbow):
             I += e**2 * J
 
         if pol==0: I /= 2
-        return 2*np.pi*sa/self.x/theta0**2/np.sin(theta)*I
+        I = 2*np.pi*sa/self.x/theta0**2/np.sin(theta)*I
+        record('AiryRainbow.intensity', t0, np.size(I))
+        return I
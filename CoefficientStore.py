@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from hashlib import sha1
+
+class CoefficientStore:
+    """ persistent store of coefficient arrays on disk
+    usage: MieRainbow.store = CoefficientStore(path)
+      then Mie coefficients are saved in path and reused
+      by later MieRainbow objects (also in other processes)
+    """
+    def __init__(self, path, max_bytes=2**32):
+        """
+        path: string
+          directory of the store (created if not exist)
+        max_bytes: int, scalar
+          upper limit of total size of stored arrays / byte.
+          least recently used entries are removed if exceeded
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, *args):
+        """
+        args: floats, ints, strings or bools
+          parameters that determine the arrays
+          (floats are distinguished up to the last bit)
+        return: key
+          key: string, hash of args
+        """
+        args = [float(a).hex() if isinstance(a, (float, np.floating))
+                else repr(a) for a in args]
+        return sha1(' '.join(args).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        key: string
+          key returned by self.key()
+        return: c
+          c: dictionary of arrays (memory-mapped, read-only)
+            None if key is not in the store
+        """
+        d = os.path.join(self.path, key)
+        try:
+            c = {f[:-4]: np.load(os.path.join(d,f), mmap_mode='r')
+                 for f in os.listdir(d)}
+            os.utime(d) # mark as recently used
+        except FileNotFoundError: return None # not stored or evicted
+        return c
+
+    def save(self, key, c):
+        """
+        key: string
+          key returned by self.key()
+        c: dictionary of arrays
+          arrays to be saved (as name.npy)
+        """
+        d = os.path.join(self.path, key)
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.path)
+        for k,v in c.items(): np.save(os.path.join(tmp, k + '.npy'), v)
+        try: os.rename(tmp, d) # atomic
+        except OSError: shutil.rmtree(tmp) # saved by other process
+        self.evict()
+
+    def evict(self):
+        """ remove least recently used entries
+        until total size is less than max_bytes """
+        e = []
+        for k in os.listdir(self.path):
+            if k.startswith('.tmp'): continue
+            d = os.path.join(self.path, k)
+            try:
+                s = sum(os.path.getsize(os.path.join(d,f))
+                        for f in os.listdir(d))
+                e.append((os.path.getmtime(d), s, d))
+            except FileNotFoundError: pass # removed by other process
+
+        total = sum(s for _,s,_ in e)
+        for _,s,d in sorted(e):
+            if total <= self.max_bytes: break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= s
+
+    def nbytes(self):
+        """ return: total size of stored arrays / byte """
+        return sum(os.path.getsize(os.path.join(r,f))
+                   for r,_,f in os.walk(self.path) for f in f)
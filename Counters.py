@@ -0,0 +1,116 @@
+import time
+from threading import Lock
+
+_active = None # Counters being recorded (None if disabled)
+_caches = {} # name -> function returning (hits, misses)
+
+class Counters:
+    """ opt-in registry of per-stage call counts, cumulative time,
+    array sizes and cache hit rates of the rainbow models,
+    riccati_jn, averaging drivers and diagram builders
+    usage:
+      with Counters() as c:
+          LeeDiagram(...)
+      print(c.report())
+    comment: when no Counters is active, each instrumented stage
+      costs only a function call returning immediately
+      (see clock and record). stages evaluated in worker
+      processes (executor='process') are not counted
+    """
+    def __init__(self):
+        self.data = {} # name -> [calls, time, size, hits, misses]
+        self.lock = Lock()
+        self.start = {} # name -> (hits, misses) of registered caches
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('Counters is already active')
+        self.start = {k: tuple(f()) for k,f in _caches.items()}
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = None
+        for k,f in _caches.items(): # hits and misses while active
+            h,m = f()
+            h0,m0 = self.start.get(k, (0,0))
+            if h > h0 or m > m0: self.add(k, hits=h-h0, misses=m-m0)
+
+    def add(self, name, t=0, size=0, calls=0, hits=0, misses=0):
+        """ add to counters of stage name """
+        with self.lock:
+            c = self.data.setdefault(name, [0, 0., 0, 0, 0])
+            c[0] += calls
+            c[1] += t
+            c[2] += size
+            c[3] += hits
+            c[4] += misses
+
+    def stats(self):
+        """ return: dictionary of stage name -> dictionary of
+          'calls': number of calls
+          'time': cumulative time / sec
+          'size': cumulative number of array elements processed
+          'hits', 'misses': number of cache hits and misses
+          'hit_rate': hits/(hits + misses) (None if no access)
+        """
+        with self.lock:
+            s = {}
+            for k,(n,t,z,h,m) in sorted(self.data.items()):
+                s[k] = {'calls': n, 'time': t, 'size': z,
+                        'hits': h, 'misses': m,
+                        'hit_rate': h/(h+m) if h+m else None}
+            return s
+
+    def report(self):
+        """ return: string, table of stats() """
+        r = ['%-36s %8s %10s %12s %8s' %
+             ('stage', 'calls', 'time/s', 'size', 'hit rate')]
+        for k,s in self.stats().items():
+            h = '' if s['hit_rate'] is None else '%.3f' % s['hit_rate']
+            r.append('%-36s %8d %10.4f %12d %8s' %
+                     (k, s['calls'], s['time'], s['size'], h))
+        return '\n'.join(r)
+
+def clock():
+    """ return: perf_counter() if Counters is active, else None
+      (start time to be passed to record) """
+    return None if _active is None else time.perf_counter()
+
+def record(name, t0=None, size=0, calls=1):
+    """ record call of stage name (if Counters is active)
+    name: string
+      name of stage (e.g. 'MieRainbow.coefficients')
+    t0: float, scalar
+      start time returned by clock()
+      if None, time is not recorded
+    size: int, scalar
+      number of array elements processed
+    calls: int, scalar
+      number of calls (e.g. iterations)
+    """
+    c = _active
+    if c is None: return
+    t = 0 if t0 is None else time.perf_counter() - t0
+    c.add(name, t, size, calls)
+
+def hit(name, found):
+    """ record access to cache name (if Counters is active)
+    found: bool, whether item was found in cache """
+    c = _active
+    if c is None: return
+    if found: c.add(name, hits=1)
+    else: c.add(name, misses=1)
+
+def register_cache(name, info):
+    """ register cache that counts its own hits and misses
+    (e.g. functools.lru_cache), so that they are
+    recorded by Counters at no cost in the hot path
+    name: string
+      name of cache
+    info: function
+      info() returns (hits, misses) so far
+    """
+    _caches[name] = info
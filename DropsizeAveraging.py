@@ -3,19 +3,25 @@ from Rainbow import Rainbow
 from MieRainbow import MieRainbow
 from RefractiveIndex import IndexFromWavlen
 from scipy.stats import lognorm
-from WavlenAveraging import WavlenAveraging
+from numpy.polynomial.legendre import leggauss
+from WavlenAveraging import WavlenAveraging, MieAveragedIntensity
+from RainbowBatch import RainbowBatch
+from Counters import clock, record
 
 def DropsizeAveraging(rbow, theta, a,
                       sigma=0, width=0.95,
                       wavlen=None, rv=None,
-                      N_dropsize=16, **kw):
+                      N_dropsize=16, quad='uniform', err=False,
+                      executor=None, workers=None, **kw):
     """ average rainbow light over raindrop sizes
     rbow: Rainbow class (NOT Rainbow object)
       either Rainbow, YoungRainbow, AiryRainbow or MieRainbow
     theta: float, 1d-array
       angle between sun and raindrop / radian
-    a: float, scalar
+    a: float, scalar or 1d-array
       mean radius of raindrop distribution / m
+      if a is 1d-array, all radii (and their averaging points)
+      are evaluated in one batch
     sigma: float, scalar
       standard deviation of a / m
       if sigma <= 0, averaging is not performed
@@ -30,40 +36,124 @@ def DropsizeAveraging(rbow, theta, a,
        if rv is None, lognormal distribution is used
     N_dropsize: int, scalar
       number of averaging points
+    quad: string
+      quadrature rule of averaging over raindrop sizes
+      'uniform': uniform points weighted by pdf of rv
+      'gauss': Gauss-Legendre rule weighted by pdf of rv
+      'clenshaw-curtis': Clenshaw-Curtis rule weighted by pdf of rv
+      'gauss' and 'clenshaw-curtis' typically reach accuracy
+      of 'uniform' with about half of N_dropsize
+    err: bool
+      if True, error estimate of averaging is also returned,
+      which is difference from embedded rule on every other
+      points (quad must be 'uniform' or 'clenshaw-curtis'
+      and N_dropsize must be odd)
+    executor: string or instance of concurrent.futures.Executor
+      executor of evaluations for each dropsize
+      (see ParallelMap.py)
+    workers: int, scalar
+      number of workers (see ParallelMap.py)
     kw: dictionary
       keyword arguments passed to Rainbow.averaged_intensity()
       except that kw['ord_max'] is passed to MieRainbow.__init__()
     return: I
       I: float, shape(len(theta),) if wavlen is not None,
                 shape(3 or 4, len(theta)) if wavlen is None
-        averaged intensity
+        averaged intensity.
+        if a is 1d-array, I has leading axis of length len(a)
+      E: float, same shape as I (returned if err is True)
+        error estimate of I (zero if sigma <= 0)
     """
-    a = np.atleast_1d(a)
+    t0 = clock()
+    shape = np.shape(a)
+    a = np.reshape(a, (-1,1))
     if sigma > 0: 
         if rv is None: rv = lognorm(1) # lognormal distribution
-        x1,x2 = rv.ppf(((1-width)/2, (1+width)/2))
-        x = np.linspace(x2, x1, N_dropsize)
-        p = rv.pdf(x)
+        x,p,q = _dropsize_nodes(rv, N_dropsize, width, quad, err)
         # radius of raindrop (in decreasing order)
         a = a + sigma*(x - rv.mean())/rv.std()
-        if a[-1]<0: raise RuntimeError("a<0")
+        if np.any(a[:,-1]<0): raise RuntimeError("a<0")
+    a = a.reshape(-1)
 
     if wavlen is None:
-        I = [WavlenAveraging(rbow, theta, a, **kw) for a in a]
+        I = WavlenAveraging(rbow, theta, a,
+                            executor=executor, workers=workers, **kw)
     else:
         m = IndexFromWavlen(wavlen)
         x = 2*np.pi*a/wavlen
-        if rbow == MieRainbow and 'ord_max' in kw:
-            ord_max = kw.pop('ord_max')
-            r = [rbow(m, x, ord_max) for x in x]
+        if rbow == MieRainbow:
+            m = np.full(len(x), m)
+            I = MieAveragedIntensity(m, x, theta, executor, workers, **kw)
         elif issubclass(rbow, Rainbow):
-            r = [rbow(m,x) for x in x]
+            I = RainbowBatch(rbow, m, x).averaged_intensity(theta, **kw)
         else:
             raise RuntimeError('rbow is not Rainbow')
 
-        I = [r.averaged_intensity(theta, **kw) for r in r]
+    if sigma <= 0:
+        I = np.squeeze(I)
+        record('DropsizeAveraging', t0, I.size)
+        if not err: return I
+        return I, np.zeros_like(I)
+
+    I = np.reshape(I, (-1, len(p)) + np.shape(I)[1:])
+    J = np.einsum('j,ij...->i...', p,I)
+    J = J.reshape(shape + J.shape[1:])
+    record('DropsizeAveraging', t0, J.size)
+    if not err: return J
 
-    if sigma <= 0: return np.squeeze(I)
+    E = np.einsum('j,ij...->i...', q,I)
+    E = np.abs(J - E.reshape(J.shape))
+    return J,E
 
-    I = np.einsum('i,i...', p,I)
-    return I/np.sum(p)
+def _dropsize_nodes(rv, N, width, quad, err=False):
+    """ nodes and weights of averaging over rv
+    (see DropsizeAveraging for arguments)
+    return: x, p, q
+      x: float, 1d-array of length N
+        nodes in decreasing order
+      p: float, 1d-array of length N
+        weights (normalized so that sum(p) == 1)
+      q: float, 1d-array of length N
+        weights of embedded rule on x[::2]
+        (zero on x[1::2], None if err is False)
+    """
+    x1,x2 = rv.ppf(((1-width)/2, (1+width)/2))
+    if quad == 'uniform':
+        x = np.linspace(x2, x1, N)
+        p = rv.pdf(x)
+    elif quad == 'gauss':
+        x,p = leggauss(N)
+        x = (x2 + x1)/2 + (x2 - x1)/2*x[::-1]
+        p = p[::-1]*rv.pdf(x)
+    elif quad == 'clenshaw-curtis':
+        x,p = _clenshaw_curtis(N)
+        x = (x2 + x1)/2 + (x2 - x1)/2*x
+        p = p*rv.pdf(x)
+    else:
+        raise RuntimeError('bad quad')
+
+    if not err: return x, p/np.sum(p), None
+    if N%2 == 0 or quad not in ('uniform', 'clenshaw-curtis'):
+        raise RuntimeError('error estimate is not available')
+
+    q = np.zeros(N)
+    if quad == 'uniform': q[::2] = p[::2]
+    else: q[::2] = _clenshaw_curtis(N//2 + 1)[1]*rv.pdf(x[::2])
+    return x, p/np.sum(p), q/np.sum(q)
+
+def _clenshaw_curtis(N):
+    """ nodes and weights of Clenshaw-Curtis rule on [-1,1]
+    N: int, scalar
+      number of nodes (N >= 2)
+    return: x, w
+      x: float, 1d-array, cos(k*pi/(N-1)) (k=0,...,N-1)
+      w: float, 1d-array, weights of the nodes
+    """
+    n = N-1
+    k = np.arange(N)
+    x = np.cos(np.pi*k/n)
+    j = np.arange(1, n//2 + 1)
+    b = np.where(2*j == n, 1, 2)
+    c = np.where((k==0) | (k==n), 1, 2)
+    v = np.cos(2*np.pi*np.outer(k,j)/n) @ (b/(4*j*j - 1))
+    return x, c*(1 - v)/n
@@ -3,11 +3,14 @@
 #     www.philiplaven.com/p2b.html
 
 import numpy as np
+from Rainbow import Rainbow
 from DropsizeAveraging import DropsizeAveraging
 from scipy.interpolate import interp1d
+from Counters import clock, record
 
 def LavenDiagram(rbow, a, x1, x2, y1, y2, NX,
-                 N_theta=256, interp='linear', **kw):
+                 N_theta=256, interp='linear',
+                 executor=None, workers=None, **kw):
     """ computer graphics of rainbow
     rbow: Rainbow class (NOT Rainbow object)
       either AiryRainbow or MieRainbow
@@ -23,16 +26,135 @@ def LavenDiagram(rbow, a, x1, x2, y1, y2, NX,
       (to be interpolated)
     interp: string or int, scalar
       what kind of interpolation to use in interp1d
+      if 'linear', pixel to theta index and weight are
+      computed once and reused for all radii
+    executor: string or instance of concurrent.futures.Executor
+      executor of DropsizeAveraging (see ParallelMap.py)
+    workers: int, scalar
+      number of workers (see ParallelMap.py)
     kw: dictionary
       keyword arguments passed to DropsizeAveraging
       if 'a_sigma' in kw, then dropsize averaging is
       performed with (a, a_sigma) == (mean, std dev)
+      if 'tol' in kw and kw['r'] == 0 (point source),
+      intensity is sampled adaptively in theta
+      (see Rainbow.averaged_intensity)
     return: img
       img: float, shape(NY,NX,3) or (len(a),NY,NX,3)
         where NY = image height / pixel.
         computer graphics of rainbow
         to be input to matplotlib.pyplot.imshow()
     """
+    t0 = clock()
+    theta,th = _laven_grid(x1, x2, y1, y2, NX, N_theta)
+
+    # all radii in one batch
+    I = DropsizeAveraging(rbow, theta, np.atleast_1d(a),
+                          executor=executor, workers=workers, **kw)
+    I = np.reshape(I, (np.size(a), -1, N_theta))
+    t1 = clock()
+
+    img = _laven_image(I, theta, th, interp)
+    record('LavenDiagram.image', t1, img.size)
+    record('LavenDiagram', t0, img.size)
+    return img
+
+def LavenDiagramProgressive(rbow, a, x1, x2, y1, y2, NX,
+                            N_theta=256, interp='linear',
+                            frame_tol=0, N_init=9, preview=None,
+                            executor=None, workers=None, **kw):
+    """ generator of successively refined Laven diagrams
+    see LavenDiagram for rbow, a, x1, x2, y1, y2, NX,
+    N_theta, interp, executor, workers, kw
+    frame_tol: float, scalar
+      intervals of theta are bisected until relative error
+      of linear interpolation between computed theta is
+      less than frame_tol. if frame_tol == 0, last image
+      agrees with LavenDiagram up to rounding error
+    N_init: int, scalar
+      number of theta computed in first step (at least 2)
+    preview: Rainbow class (NOT Rainbow object)
+      if not None, first image is computed by preview
+      (e.g. AiryRainbow) as cheap stand-in for rbow
+    yield: img
+      img: float, same shape as LavenDiagram returns
+        normalized as in LavenDiagram, where intensities
+        at theta not yet computed are linearly interpolated
+        from computed ones
+    comment: intensity of point source is computed on
+      integration grid of source averaging (see
+      Rainbow.averaged_intensity) only within distance r
+      from computed theta, and each grid point is computed
+      only once, so that all images together cost no more
+      than LavenDiagram. kw['tol'] is not used
+    """
+    if preview is not None:
+        p = {k:v for k,v in kw.items() if k != 'ord_max'}
+        yield LavenDiagram(preview, a, x1, x2, y1, y2, NX,
+                           N_theta, interp, **p)
+
+    a = np.atleast_1d(a)
+    theta,th = _laven_grid(x1, x2, y1, y2, NX, N_theta)
+    r = kw.pop('r', Rainbow.SUN_RADIUS)
+    dx = kw.pop('dx', 1e-3)
+    kw.pop('tol', None)
+    if r<dx: N,w = 1, np.ones(1) # no averaging
+    else: # same grid and kernel as averaged_intensity
+        N = int(np.ceil((theta[1] - theta[0])/dx))
+        dx = (theta[1] - theta[0])/N
+        w = Rainbow.disk_kernel(r, dx)*dx*2/np.pi/r**2
+    M = len(w)//2
+    u = np.linspace(theta[0] - M*dx, theta[-1] + M*dx,
+                    N*(N_theta - 1) + 2*M + 1)
+    have = np.zeros(len(u), dtype=bool)
+    P = [] # intensity of point source on u (allocated at first call)
+
+    def f(k): # averaged intensities at theta[k]
+        i = N*k[:,None] + np.arange(2*M+1)
+        j = np.unique(i[~have[i]])
+        if len(j):
+            J = DropsizeAveraging(rbow, u[j], a, r=0, executor=executor,
+                                  workers=workers, **kw)
+            J = np.reshape(J, (len(a), -1, len(j)))
+            if not P: P.append(np.zeros(J.shape[:-1] + u.shape))
+            P[0][...,j] = J
+            have[j] = True
+        return np.dot(P[0][...,i], w[::-1])
+
+    k = np.linspace(0, N_theta-1, min(N_theta, max(N_init, 2)))
+    k = np.unique(k.astype(int))
+    I = f(k)
+    i = np.arange(len(k)-1) # left ends of intervals to be refined
+
+    while True:
+        j = np.searchsorted(k, np.arange(N_theta), 'right') - 1
+        j = np.clip(j, 0, len(k)-2)
+        t = (np.arange(N_theta) - k[j])/(k[j+1] - k[j])
+        yield _laven_image(I[...,j]*(1-t) + I[...,j+1]*t, theta, th, interp)
+
+        i = i[k[i+1] - k[i] > 1]
+        if len(i)==0: return
+        m = (k[i] + k[i+1])//2
+        J = f(m)
+        t = (m - k[i])/(k[i+1] - k[i])
+        d = np.abs(J - I[...,i]*(1-t) - I[...,i+1]*t)
+        d = np.max(np.reshape(np.moveaxis(d, -1, 0), (len(i), -1)), axis=1)
+        d = d >= frame_tol*np.max(np.abs(I)) # all if frame_tol == 0
+        k = np.insert(k, i+1, m)
+        I = np.insert(I, i+1, J, axis=-1)
+        i = i[d] + np.arange(len(i))[d] # index after insertion
+        i = np.ravel(np.c_[i, i+1])
+
+def _laven_grid(x1, x2, y1, y2, NX, N_theta):
+    """ evaluation points and pixels of Laven diagram
+    (see LavenDiagram for arguments)
+    return: theta, th
+      theta: float, 1d-array of length N_theta
+        evaluation points of rainbow intensity / radian
+      th: float, shape(NY,NX)
+        angle between sun and raindrop at each pixel / radian
+        where NY = image height / pixel
+    """
     th1 = np.pi - np.hypot(x2,y2)
     th2 = np.pi - np.hypot(x1,y1)
     # evaluation points of rainbow intensity
@@ -42,13 +164,23 @@ def LavenDiagram(rbow, a, x1, x2, y1, y2, NX,
 
     x,y = np.meshgrid(np.linspace(x1,x2,NX),
                       np.linspace(y1,y2,NY))
-    th = np.hypot(x,y)
+    return theta, np.pi - np.hypot(x,y)
 
-    img = []
-    for a in np.atleast_1d(a):
-        I = DropsizeAveraging(rbow, theta, a, **kw)
-        I = interp1d(theta, I, interp)
-        I = np.moveaxis(I(np.pi - th), 0, -1)
-        img.append(I/np.max(I)) # normalize
+def _laven_image(I, theta, th, interp):
+    """ normalized Laven diagram from intensities
+    I: float, shape(len(a), 3, len(theta))
+      intensities at theta (see _laven_grid for theta, th)
+    interp: see LavenDiagram
+    """
+    if interp == 'linear':
+        # image depends on pixel only through th
+        t = (th - theta[0])/(theta[1] - theta[0])
+        j = np.clip(t.astype(int), 0, len(theta)-2)
+        t -= j
+        img = I[...,j]*(1-t) + I[...,j+1]*t
+    else:
+        img = interp1d(theta, I, interp)(th)
 
+    img = np.moveaxis(img, 1, -1)
+    img /= np.max(img, axis=(1,2,3), keepdims=True) # normalize
     return np.squeeze(img)
@@ -2,13 +2,20 @@
 #   R. L. Lee, Jr. "Mie theory, Airy theory, and
 #     the natural rainbow" Applied Optics 37 (1998) 1506
 
+import os
+import time
+import socket
+from hashlib import sha1
 import numpy as np
 from WavlenAveraging import WavlenAveraging
+from ParallelMap import ParallelMap
 from scipy.stats import norm
 from scipy.ndimage import convolve1d
+from Counters import clock, record
 
 def LeeDiagram(rbow, theta, a,
-               sigma=0, h=0.05, width=0.95, **kw):
+               sigma=0, h=0.05, width=0.95,
+               executor=None, workers=None, **kw):
     """ diagram of rainbow colors on (theta,a) plane
     rbow: Rainbow class (NOT Rainbow object)
       either AiryRainbow or MieRainbow
@@ -28,35 +35,303 @@ def LeeDiagram(rbow, theta, a,
     width: float, scalar
       range of averaging integral over log(a) (0 < width < 1)
       width is ignored if sigma < h
+    executor: string or instance of concurrent.futures.Executor
+      executor of WavlenAveraging for each radius
+      (see ParallelMap.py)
+    workers: int, scalar
+      number of workers (see ParallelMap.py)
     kw: dictionary
       keyword arguments passed to WavlenAveraging.
+      if 'tol' in kw and kw['r'] == 0 (point source),
+      intensity is sampled adaptively in theta
+      (see Rainbow.averaged_intensity)
     return: img
       img: float, shape(len(a), len(theta), 3)
         Lee diagram, to be input to matplotlib.pyplot.imshow()
     comment: if rbow == Mie, averaging over a is very
       time consuming. To reduce time, set kw['N_wavlen'] = 16.
     """
-    if sigma < h:
-        I = [WavlenAveraging(rbow, theta, a, **kw).T
-             for a in a[::-1]] # decreasing order
-    else: # averaging over radius of raindrop
-        dlna = np.diff(np.log(a))
-        if not np.allclose(dlna, dlna[0]):
-            raise RuntimeError('a is not geomspace')
-        N = int(np.ceil(dlna[0]/np.log1p(h)))
-        h = dlna[0]/N
-        b = np.geomspace(a[0], a[-1], N*len(dlna) + 1)
-
-        d = np.log1p(sigma)*norm.ppf((1+width)/2)
-        M = int(np.floor(d/h))
-        x = h*np.arange(-M, M+1)
-        y = np.exp(x)
-        w = norm.pdf(x)
-        b = np.r_[b[0]*y[:M], b, b[-1]*y[M+1:]]
-        I = [WavlenAveraging(rbow, theta, b, **kw).T
-             for b in b[::-1]] # decreasing order
+    t0 = clock()
+    b,w,M,N = _radius_grid(a, sigma, h, width)
+    I = ParallelMap(WavlenAveraging,
+                    [(rbow, theta, b) for b in b[::-1]], # decreasing order
+                    executor, workers, **kw)
+    I = [I.T for I in I]
+    img = _lee_image(I, w, M, N)
+    record('LeeDiagram', t0, img.size)
+    return img
+
+def LeeDiagramTiled(rbow, theta, a, path,
+                    sigma=0, h=0.05, width=0.95,
+                    tile=(4, None), timeout=None, **kw):
+    """ same as LeeDiagram, but computed tile by tile
+    through work queue in directory path, so that any number
+    of processes (on any nodes sharing path) can run this
+    function with the same arguments, and computation can be
+    resumed after crash by running this function again.
+    see LeeDiagram for rbow, theta, a, sigma, h, width, kw
+    path: string
+      directory of work queue (created if not exist)
+      path/tile_k.npy is array of intensities of k-th tile
+    tile: int, tuple (of length 2)
+      number of radii and theta in each tile
+      (None for all theta). theta in tile must be >= 2,
+      and last tile of theta is merged into previous one
+      if it would have only one theta.
+      if theta is split, result agrees with LeeDiagram
+      up to rounding error (otherwise it is identical)
+    timeout: float, scalar
+      tile claimed but not finished for timeout / sec is
+      assumed to be abandoned and is claimed again.
+      claims of crashed processes on the same host are
+      detected by process id and claimed again at once.
+      if None, claims of other hosts never expire.
+      timeout is also applied to initialization of queue
+    return: img
+      img: float, shape(len(a), len(theta), 3)
+        Lee diagram if all tiles are finished,
+        None if other processes are still working on tiles
+    comment: queue is bound to rbow, kw, tile and grid of
+      (theta, radius). RuntimeError is raised if path has
+      queue of different parameters
+    """
+    b,w,M,N = _radius_grid(a, sigma, h, width)
+    b = b[::-1] # decreasing order
+    nb = tile[0]
+    nt = len(theta) if tile[1] is None else tile[1]
+    if nt < 2 and len(theta) > 1:
+        raise RuntimeError('tile must have at least 2 theta')
+    j = list(range(0, len(theta), nt))
+    if len(j) > 1 and len(theta) - j[-1] < 2: j.pop() # merge last
+    j.append(len(theta))
+    tiles = [(i,j0,j1) for i in range(0, len(b), nb)
+                       for j0,j1 in zip(j[:-1], j[1:])]
+
+    p = {k:v for k,v in kw.items() if k not in ('executor', 'workers')}
+    key = _param_key(rbow, p, nb, nt)
+    _open_queue(path, theta, b, key, timeout)
+
+    for k,(i,j0,j1) in enumerate(tiles):
+        if not _claim(path, k, timeout): continue
+        t = theta[j0:j1]
+        _save_tile(path, k, [WavlenAveraging(rbow, t, b, **kw).T
+                             for b in b[i:i+nb]])
+        open(os.path.join(path, 'done', str(k)), 'w').close()
+
+    done = os.listdir(os.path.join(path, 'done'))
+    if len(done) < len(tiles): return None
+    I = np.empty((len(b), len(theta), 3))
+    for k,(i,j0,j1) in enumerate(tiles):
+        I[i:i+nb, j0:j1] = np.load(os.path.join(path, 'tile_%d.npy' % k))
+    return _lee_image(I, w, M, N)
+
+def LeeDiagramProgressive(rbow, theta, a,
+                          sigma=0, h=0.05, width=0.95,
+                          frame_tol=0, N_init=5, preview=None,
+                          executor=None, workers=None, **kw):
+    """ generator of successively refined Lee diagrams
+    see LeeDiagram for rbow, theta, a, sigma, h, width,
+    executor, workers, kw
+    frame_tol: float, scalar
+      radii are bisected until relative error of linear
+      interpolation between computed radii is less than
+      frame_tol. if frame_tol == 0, last image is identical
+      to LeeDiagram
+    N_init: int, scalar
+      number of radii computed in first step (at least 2
+      unless a has only one radius)
+    preview: Rainbow class (NOT Rainbow object)
+      if not None, first image is computed by preview
+      (e.g. AiryRainbow) as cheap stand-in for rbow
+    yield: img
+      img: float, shape(len(a), len(theta), 3)
+        Lee diagram normalized as in LeeDiagram, where
+        intensities at radii not yet computed are linearly
+        interpolated (in log a) from computed ones
+    usage: for img in LeeDiagramProgressive(...):
+               plt.imshow(img) # stop when good enough
+    """
+    if preview is not None:
+        p = {k:v for k,v in kw.items() if k != 'ord_max'}
+        yield LeeDiagram(preview, theta, a, sigma, h, width, **p)
+
+    b,w,M,N = _radius_grid(a, sigma, h, width)
+    b = b[::-1] # decreasing order
+
+    def f(k): # intensities at radii b[k]
+        I = ParallelMap(WavlenAveraging, [(rbow, theta, b) for b in b[k]],
+                        executor, workers, **kw)
+        return np.array([I.T for I in I])
+
+    k = np.linspace(0, len(b)-1, min(len(b), max(N_init, 2)))
+    k = np.unique(k.astype(int))
+    I = f(k)
+    if len(b)==1: # nothing to interpolate
+        yield _lee_image(I, w, M, N)
+        return
+    i = np.arange(len(k)-1) # left ends of intervals to be refined
+
+    while True:
+        j = np.searchsorted(k, np.arange(len(b)), 'right') - 1
+        j = np.clip(j, 0, len(k)-2)
+        t = ((np.arange(len(b)) - k[j])/(k[j+1] - k[j]))[:,None,None]
+        yield _lee_image(I[j]*(1-t) + I[j+1]*t, w, M, N)
+
+        i = i[k[i+1] - k[i] > 1]
+        if len(i)==0: return
+        m = (k[i] + k[i+1])//2
+        J = f(m)
+        t = ((m - k[i])/(k[i+1] - k[i]))[:,None,None]
+        d = np.abs(J - I[i]*(1-t) - I[i+1]*t)
+        d = np.max(d, axis=(1,2)) > frame_tol*np.max(np.abs(I))
+        k = np.insert(k, i+1, m)
+        I = np.insert(I, i+1, J, axis=0)
+        i = i[d] + np.arange(len(i))[d] # index after insertion
+        i = np.ravel(np.c_[i, i+1])
+
+def _radius_grid(a, sigma, h, width):
+    """ radii of raindrop at which intensity is evaluated
+    (see LeeDiagram for arguments)
+    return: b, w, M, N
+      b: float, 1d-array
+        radii in increasing order
+      w: float, 1d-array (length 2M+1)
+        weight of averaging over log(a) (None if sigma < h)
+      M,N: int, scalars
+        b[M::N] is a (0 and 1 if sigma < h)
+    """
+    if sigma < h: return a, None, 0, 1
+
+    dlna = np.diff(np.log(a))
+    if not np.allclose(dlna, dlna[0]):
+        raise RuntimeError('a is not geomspace')
+    N = int(np.ceil(dlna[0]/np.log1p(h)))
+    h = dlna[0]/N
+    b = np.geomspace(a[0], a[-1], N*len(dlna) + 1)
+
+    d = np.log1p(sigma)*norm.ppf((1+width)/2)
+    M = int(np.floor(d/h))
+    x = h*np.arange(-M, M+1)
+    y = np.exp(x)
+    w = norm.pdf(x)
+    b = np.r_[b[0]*y[:M], b, b[-1]*y[M+1:]]
+    return b, w, M, N
+
+def _lee_image(I, w, M, N):
+    """ Lee diagram from intensities I evaluated at
+    radii b[::-1] (see _radius_grid for b, w, M, N) """
+    t0 = clock()
+    if w is not None: # averaging over radius of raindrop
         I = convolve1d(I, w, axis=0) # averaging by convolution
         I = I[M:-M:N]
 
-    img = I/np.max(I, axis=(1,2)).reshape(len(a),1,1)
+    I = np.asarray(I)
+    img = I/np.max(I, axis=(1,2)).reshape(len(I),1,1)
+    record('LeeDiagram.image', t0, img.size)
     return img[::-1]
+
+def _param_key(*args):
+    """ sha1 of parameters (classes, objects, dictionaries,
+    arrays and scalars) that determine intensities of queue """
+    h = sha1()
+    def update(a):
+        if isinstance(a, type):
+            h.update((a.__module__ + '.' + a.__qualname__).encode())
+        elif isinstance(a, dict):
+            for k in sorted(a): update(k); update(a[k])
+        elif isinstance(a, (list, tuple)):
+            h.update(b'(')
+            for x in a: update(x)
+            h.update(b')')
+        elif isinstance(a, np.ndarray):
+            h.update(('%s%s' % (a.dtype.str, a.shape)).encode())
+            h.update(np.ascontiguousarray(a).data)
+        elif hasattr(a, '__dict__'): # other objects by their state
+            update(type(a))
+            update(vars(a))
+        else:
+            h.update(repr(a).encode())
+    for a in args: update(a)
+    return h.hexdigest()
+
+def _create(f):
+    """ create file f exclusively with host name and process id
+    return: True if created, False if f exists """
+    try: fd = os.open(f, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError: return False
+    os.write(fd, ('%s %d' % (socket.gethostname(), os.getpid())).encode())
+    os.close(fd)
+    return True
+
+def _abandoned(f, timeout):
+    """ whether file f created by _create is abandoned, i.e.
+    its process on this host is dead, or it is older than timeout """
+    try:
+        with open(f) as g: host,pid = g.read().split()
+        if host == socket.gethostname():
+            os.kill(int(pid), 0) # check existence
+    except ProcessLookupError: return True
+    except (FileNotFoundError, ValueError, PermissionError): pass
+    try: age = time.time() - os.path.getmtime(f)
+    except FileNotFoundError: return False # removed by other process
+    return timeout is not None and age > timeout
+
+def _remove(f):
+    """ remove abandoned file f
+    return: True if removed by this process """
+    try: os.rename(f, '%s.%d.%d' % (f, os.getpid(), time.time_ns()))
+    except FileNotFoundError: return False
+    return True
+
+def _open_queue(path, theta, b, key, timeout=None):
+    """ create (or open existing) work queue in directory path
+    key: string
+      hash of parameters other than theta and b (see _param_key)
+    timeout: float, scalar
+      initialization by other process is abandoned
+      if not finished for timeout / sec
+    """
+    for d in ('claim', 'done'):
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+    grid = os.path.join(path, 'grid.npz')
+    init = os.path.join(path, 'init')
+    ready = os.path.join(path, 'ready')
+    if _create(init): # first process initializes queue
+        np.savez(grid, theta=theta, b=b, key=key)
+        open(ready, 'w').close()
+    else:
+        while not os.path.exists(ready):
+            if _abandoned(init, timeout): # creator crashed
+                _remove(init)
+                return _open_queue(path, theta, b, key, timeout)
+            time.sleep(1)
+
+    g = np.load(grid)
+    if(g['theta'].shape != np.shape(theta) or g['b'].shape != b.shape or
+       not np.all(g['theta'] == theta) or not np.all(g['b'] == b) or
+       'key' not in g or str(g['key']) != key):
+        raise RuntimeError('work queue has different parameters')
+
+def _save_tile(path, k, I):
+    """ write intensities I of k-th tile to path/tile_k.npy
+    through temporary file and atomic rename, so that tiles
+    are never partially written or overwritten by other hosts """
+    f = os.path.join(path, 'tile_%d.npy' % k)
+    tmp = '%s.%d.%d' % (f, os.getpid(), time.time_ns())
+    with open(tmp, 'wb') as g:
+        np.save(g, np.asarray(I))
+        g.flush()
+        os.fsync(g.fileno()) # before done marker is visible
+    os.replace(tmp, f)
+
+def _claim(path, k, timeout):
+    """ try to claim k-th tile
+    return: True if claimed, False if finished or
+      being computed by other process """
+    if os.path.exists(os.path.join(path, 'done', str(k))): return False
+    claim = os.path.join(path, 'claim', str(k))
+    if _create(claim): return True
+    if not _abandoned(claim, timeout): return False
+    # take over abandoned tile (only one process succeeds)
+    if not _remove(claim): return False
+    return _claim(path, k, None)
@@ -1,9 +1,135 @@
 import numpy as np
-from scipy.special import riccati_yn, lpmn
-from riccati_jn import riccati_jn
+from riccati_jn import riccati_bessel, log_derivative
 from Rainbow import Rainbow
+from collections import OrderedDict
+from threading import Lock
+from hashlib import sha1
+from Counters import clock, record, hit
 # scipy.special.riccati_jn doesn't work when x > 4400
 
+def angular_functions(theta, n, k0=0, p=None):
+    """ angle-dependent functions pi_n and tau_n
+    by upward recurrence (Bohren and Huffman eq(4.47))
+    theta: float, any shape
+      angle of scattering / radian
+    n: int, scalar
+      maximum order
+    k0: int, scalar
+      if k0 > 0, recurrence is resumed from k = k0+1
+    p: float, tuple
+      (pi_{k0-1}, pi_k0) as returned by this function
+      (1d-arrays of length theta.size), used if k0 > 0
+    return: pi, tau
+      pi, tau: float, shape (theta.size, n-k0)
+        pi_k and tau_k (k=k0+1,...,n) for each theta.
+        sign is reversed from Bohren and Huffman
+        (consistent with Condon-Shortley phase in lpmn)
+    """
+    t0 = clock()
+    mu = np.cos(np.reshape(theta, -1))
+    pi = np.empty((max(n-k0, 1)+1, mu.size)) # pi_k (k=k0,k0+1,...)
+    if k0==0: pi[0], pi[1] = 0, 1
+    else: # pi_k0 and pi_{k0+1}
+        pi[0], pi[1] = -p[1], -((2*k0+1)*mu*p[1] - (k0+1)*p[0])/k0
+    k = np.arange(k0+1, n+1)
+    a,b = (2*k+1)/k, (k+1)/k
+    q = np.empty_like(mu)
+    for i in range(1, n-k0): # in-place to avoid temporaries
+        np.multiply(pi[i], mu, out=q)
+        q *= a[i-1]
+        np.subtract(q, b[i-1]*pi[i-1], out=pi[i+1])
+    k,pi = k[:,None], pi[:n-k0+1]
+    tau = k*mu*pi[1:] - (k+1)*pi[:-1]
+    record('angular_functions', t0, tau.size)
+    return -pi[1:].T, -tau.T
+
+class AngularCache:
+    """ LRU cache of angular functions pi_n and tau_n
+    shared by MieRainbow objects (see MieRainbow.cache)
+    """
+    def __init__(self, max_bytes=2**30):
+        """
+        max_bytes: int, scalar
+          upper limit of total size of cached arrays / byte
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict() # key -> (pi,tau)
+        self.lock = Lock()
+
+    def get(self, theta, n, dtype=np.float64):
+        """
+        theta: float, any shape
+          angle of scattering / radian
+        n: int, scalar
+          maximum order
+        dtype: numpy dtype
+          dtype of pi and tau (e.g. np.float32).
+          arrays of other than float64 are cast from
+          float64 arrays and cached separately
+        return: pi, tau
+          pi, tau: float, shape (theta.size, n), read-only
+            see angular_functions()
+        comment: arrays are looked up by hash of theta.
+          if cached arrays have fewer than n orders,
+          recurrence is resumed from the last two orders
+        """
+        t = np.ascontiguousarray(theta, dtype=float).reshape(-1)
+        dtype = np.dtype(dtype)
+        key = (t.size, sha1(t.data).hexdigest(), dtype.str)
+        with self.lock:
+            pt = self.data.get(key)
+            if pt is not None:
+                self.data.move_to_end(key)
+                if pt[0].shape[1] >= n:
+                    self.hits += 1
+                    hit('AngularCache', True)
+                    return pt[0][:,:n], pt[1][:,:n]
+            self.misses += 1
+            hit('AngularCache', False)
+
+        if dtype != np.float64:
+            pi,tau = self.get(t, n)
+            pi,tau = pi.astype(dtype), tau.astype(dtype)
+        elif pt is None or pt[0].shape[1] < 2:
+            pi,tau = angular_functions(t, n)
+        else: # prefix reuse
+            k0 = pt[0].shape[1]
+            pi,tau = angular_functions(t, n, k0, pt[0][:,-2:].T)
+            pi,tau = np.hstack((pt[0], pi)), np.hstack((pt[1], tau))
+
+        pi.flags.writeable = False
+        tau.flags.writeable = False
+        nbytes = pi.nbytes + tau.nbytes
+        with self.lock:
+            pt = self.data.pop(key, None)
+            if pt is not None:
+                self.nbytes -= pt[0].nbytes + pt[1].nbytes
+            if nbytes <= self.max_bytes:
+                self.data[key] = (pi,tau)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes: # evict
+                pt = self.data.popitem(last=False)[1]
+                self.nbytes -= pt[0].nbytes + pt[1].nbytes
+
+        return pi,tau
+
+    def stats(self):
+        """ return: dictionary of hits, misses, entries and nbytes """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self.data),
+                    'nbytes': self.nbytes}
+
+    def clear(self):
+        """ remove all cached arrays and reset statistics """
+        with self.lock:
+            self.data.clear()
+            self.nbytes = self.hits = self.misses = 0
+
 class MieRainbow(Rainbow):
     """ Mie theory of light scattering by spheres
     reference:
@@ -11,6 +137,14 @@ class MieRainbow(Rainbow):
         "Absorption and Scattering of Light by Small Particles" chapter 4
       E. A. Hovenac and J. A. Lock
         Journal of the Optical Society of America A9 (1992) 781
+    thread safety:
+      MieRainbow.cache (locked) and MieRainbow.store (atomic
+      rename) are shared by all objects and may be used by any
+      number of threads. arrays returned by cache are read-only.
+      objects may be constructed and evaluated concurrently,
+      provided that each object is used by one thread at a time
+      (debye_coefficients updates self.debye and self.power).
+      see MieRainbowBatch.py
     """
     def __init__(self, m, x, ord_max=None):
         """
@@ -18,31 +152,81 @@ class MieRainbow(Rainbow):
           refractive index
         x: float, scalar
           2pi*(radius of raindrop)/(wavelength of light)
+        ord_max: int, scalar
+          maximum order of Debye series (see scattering_amplitude)
+          if None, Debye series is not computed, and a_n, b_n
+          are computed from logarithmic derivative D_n(m*x),
+          which is stable and memory-saving for large x
+        comment: if MieRainbow.store is set to CoefficientStore,
+          coefficients are loaded from (or saved to) the store
+          with key (version, m, x, n, whether ord_max is None)
         """
-        y = m*x
+        super().__init__(m) # theta_r (seeds of adaptive sampling)
         n = int(x + 4*x**(1/3) + 2.5)
+        self.x = x
+        self.n = n
+        self.ord_max = ord_max
+
+        if self.store is None: c = None
+        else: # coefficients don't depend on value of ord_max
+            key = self.store.key(self.version, m, x, n, ord_max is None)
+            c = self.store.load(key)
+            hit('MieRainbow.store', c is not None)
+        if c is None:
+            c = self.coefficients(m, ord_max is not None)
+            if self.store is not None: self.store.save(key, c)
+
+        self.a = c['a']
+        self.b = c['b']
+        if ord_max is None: return
 
-        Jx,dJx = riccati_jn(n,x)
-        Nx,dNx = riccati_yn(n,x)
-        Jy,dJy = riccati_jn(n,y)
-        Ny,dNy = riccati_yn(n,y)
+        self.T = (c['Ta'], c['Tb'])
+        self.R = (c['Ra'], c['Rb'])
+        self.R22 = (c['R22a'], c['R22b'])
+        self.power = (0,1,1) # (order, R11a**order, R11b**order)
+        self.debye = {} # order -> coefficients (see debye_coefficients)
 
-        Jx,dJx = Jx[1:], dJx[1:]
-        Nx,dNx = Nx[1:], dNx[1:]
-        Jy,dJy = Jy[1:], dJy[1:]
-        Ny,dNy = Ny[1:], dNy[1:]
+    def coefficients(self, m, debye=False):
+        """
+        m: float, scalar
+          refractive index
+        debye: bool
+          if True, coefficients of Debye series are also computed
+        return: c
+          c: dictionary of complex 1d-arrays of length n
+            'a','b': Mie coefficients a_n and b_n
+            'Ta','Tb','Ra','Rb','R22a','R22b': Debye series
+              (see debye_coefficients), only if debye is True
+        """
+        t0 = clock()
+        x,n = self.x, self.n
+        y = m*x
+
+        if not debye:
+            # logarithmic derivative (Bohren and Huffman eq(4.88))
+            psi,_,chi,_ = riccati_bessel(n,x)
+            xi = psi + chi*1j
+            D = log_derivative(n,y)[1:]
+            k = np.arange(1, n+1)/x
+            c,d = D/m + k, m*D + k
+            c = {'a': (c*psi[1:] - psi[:-1])/(c*xi[1:] - xi[:-1]),
+                 'b': (d*psi[1:] - psi[:-1])/(d*xi[1:] - xi[:-1])}
+            record('MieRainbow.coefficients', t0, n)
+            return c
+
+        # psi_n, chi_n and derivatives at x and y in one call
+        J,dJ,N,dN = riccati_bessel(n, (x,y))
+        Jx,Jy = J[:,1:]
+        dJx,dJy = dJ[:,1:]
+        Nx,Ny = N[:,1:]
+        dNx,dNy = dN[:,1:]
 
         H1x = Jx + Nx*1j
         dH1x = dJx + dNx*1j
         a,b,c,d = Jx*dJy, dJx*Jy, H1x*dJy, dH1x*Jy
         a,b = (a - m*b)/(c - m*d), (m*a - b)/(m*c - d)
 
-        self.x = x
-        self.n = n
-        self.a = a
-        self.b = b
-
-        if ord_max is None: return
+        c = {'a': a, 'b': b}
 
         # Debye Series (Hovenac and Lock)
         H1y = Jy + Ny*1j
@@ -63,21 +247,59 @@ class MieRainbow(Rainbow):
         a,b = dH2x*H2y, H2x*dH2y
         R22a,R22b = (m*a - b)/Da, (a - m*b)/Db
 
-        order = np.arange(ord_max+1)
-        ap = R11a[:,np.newaxis]**order
-        bp = R11b[:,np.newaxis]**order
-        ap = -T21a * ap.T * T12a
-        bp = -T21b * bp.T * T12b
-        ap = np.vstack((1-R22a, ap))/2
-        bp = np.vstack((1-R22b, bp))/2
+        c['Ta'], c['Tb'] = -T21a*T12a/2, -T21b*T12b/2
+        c['Ra'], c['Rb'] = R11a, R11b
+        c['R22a'], c['R22b'] = (1-R22a)/2, (1-R22b)/2
+        record('MieRainbow.coefficients', t0, n)
+        return c
 
-        self.ap = ap
-        self.bp = bp
+    def debye_coefficients(self, order):
+        """ coefficients of Debye series (Hovenac and Lock)
+        order: int, scalar or 1d-array
+          number of internal reflections (-1 <= order <= ord_max)
+        return: a,b
+          a,b: complex, shape (n,)
+            a_n and b_n for the order.
+            if order is 1d-array, sum over the orders
+        comment: R11**order is computed by running product
+          from the last computed order, and the result is
+          saved in self.debye for later use
+          (sum is saved with key tuple(order))
+        """
+        if np.ndim(order):
+            key = tuple(int(p) for p in order)
+            if key not in self.debye:
+                ab = [self.debye_coefficients(p) for p in key]
+                self.debye[key] = (sum(a for a,_ in ab),
+                                   sum(b for _,b in ab))
+            return self.debye[key]
+
+        order = int(order)
+        if self.ord_max is None:
+            raise RuntimeError("Debye series is not computed")
+        hit('MieRainbow.debye', order in self.debye)
+        if order in self.debye: return self.debye[order]
+        if order < -1 or order > self.ord_max:
+            raise RuntimeError("bad order")
+
+        if order == -1: a,b = self.R22
+        else:
+            k,Ra,Rb = self.power
+            if order < k: k,Ra,Rb = 0,1,1
+            for k in range(k, order):
+                Ra,Rb = Ra*self.R[0], Rb*self.R[1]
+            self.power = (order, Ra, Rb)
+            a,b = self.T[0]*Ra, self.T[1]*Rb
+
+        self.debye[order] = (a,b)
+        return a,b
 
-    data = {'theta': np.array(0),
-            'n_max': 0} # to save
+    cache = AngularCache() # shared by all objects
+    store = None # CoefficientStore (opt-in, see __init__)
+    version = 1 # increment when coefficients are changed
 
-    def scattering_amplitude(self, theta, order=None, pol=0):
+    def scattering_amplitude(self, theta, order=None, pol=0,
+                             chunk=None, max_bytes=None, single=False):
         """
         theta: float, any shape
           angle of scattering / radian
@@ -93,6 +315,19 @@ class MieRainbow(Rainbow):
           0 for unpolarized light
           1 for perpendicular polarization
           2 for parallel polarization
+        chunk: int, scalar
+          number of theta values processed at a time.
+          if None, all theta are processed at once.
+          angular functions are not cached if chunk < theta.size
+        max_bytes: int, scalar
+          if not None, chunk is chosen so that angular
+          functions and temporaries of each chunk take
+          about max_bytes / byte (overrides chunk)
+        single: bool, scalar
+          if True, summation over n is performed in
+          single precision (float32 and complex64).
+          float32 angular functions are cached
+          in addition to float64 ones
         return: S
           S: complex, same shape as theta if pol==1 or 2
             scattering amplitude
@@ -101,51 +336,57 @@ class MieRainbow(Rainbow):
             S[0] and S[1] are for perpendicular and parallel
             polarizations, respectively
         """
-        t = np.asarray(theta)
-        if(self.data['n_max'] >= self.n and
-           self.data['theta'].size == t.size  and
-           np.all(self.data['theta'] == t.reshape(-1))):
-           pi = self.data['pi'][:,:self.n] # load data
-           tau = self.data['tau'][:,:self.n]
-        else:
-            c,s = np.cos(theta), np.sin(theta)
-            P = [lpmn(1, self.n, c) for c in c.flat]
-            P = np.moveaxis(P, 0, -1)
-            pi = np.moveaxis(P[0,1,1:]/s, -1, -2)
-            tau = np.moveaxis(-P[1,1,1:]*s, -1, -2)
-            self.data['theta'] = t.flatten() # save data
-            self.data['n_max'] = self.n
-            self.data['pi'] = pi
-            self.data['tau'] = tau
-
+        t = np.reshape(theta, -1)
         n = np.arange(1, self.n + 1)
         k = (2*n+1)/n/(n+1)
         if order is None:
             a,b = self.a, self.b
-        else:
-            p = np.asarray(order) + 1
-            a,b = self.ap[p], self.bp[p]
+        else: # coefficients are summed over orders before contraction
+            a,b = self.debye_coefficients(order)
 
         a,b = np.expand_dims((a,b), -2)
-        if   pol==1: S = np.dot(a * pi + b * tau, k)
-        elif pol==2: S = np.dot(a * tau + b * pi, k)
-        elif pol==0: S = [np.dot(a * pi + b * tau, k),
-                          np.dot(a * tau + b * pi, k)]
-        else: raise RuntimeError("bad polarization")
-        if a.ndim>2: S = np.sum(S, axis=-2)
-        if pol==0: S = np.reshape(S, (2,) + theta.shape)
-        else: S = S.reshape(theta.shape)
+        if single:
+            a,b = a.astype(np.complex64), b.astype(np.complex64)
+            k = k.astype(np.float32)
+        if max_bytes is not None:
+            row = self.n * (16 + 3*a.itemsize) # pi,tau and temporaries
+            chunk = max(1, int(max_bytes//row))
+        if chunk is None: chunk = max(1, t.size)
+
+        S = []
+        for i in range(0, max(1, t.size), chunk): # stream over theta
+            if chunk >= t.size: # float32 copies are also cached
+                pi,tau = self.cache.get(t, self.n, k.dtype)
+            else:
+                pi,tau = angular_functions(t[i:i+chunk], self.n)
+                pi = pi.astype(k.dtype, copy=False)
+                tau = tau.astype(k.dtype, copy=False)
+            t0 = clock()
+            if   pol==1: s = np.dot(a * pi + b * tau, k)
+            elif pol==2: s = np.dot(a * tau + b * pi, k)
+            elif pol==0: s = [np.dot(a * pi + b * tau, k),
+                              np.dot(a * tau + b * pi, k)]
+            else: raise RuntimeError("bad polarization")
+            record('MieRainbow.contraction', t0, pi.size)
+            S.append(s)
+
+        S = np.concatenate(S, axis=-1)
+        if pol==0: S = np.reshape(S, (2,) + np.shape(theta))
+        else: S = S.reshape(np.shape(theta))
         return S/self.x # divide by x
 
-    def intensity(self, theta, order=None, pol=0):
+    def intensity(self, theta, order=None, pol=0, **kw):
         """ scattering amplitude squared
         see scattering_amplitude() for theta, order, pol
+        kw: dictionary
+          keyword arguments passed to scattering_amplitude()
+          (chunk, max_bytes, single)
         return: I
           I: float, same shape as theta
             intensity of scattered light.
             if pol==0, I = (|S[0]|^2 + |S[1]|^2)/2
         """
-        I = np.abs(self.scattering_amplitude(theta,order,pol))**2
+        I = np.abs(self.scattering_amplitude(theta,order,pol,**kw))**2
         if pol==0: return np.mean(I, axis=0)
         else: return I
         
@@ -0,0 +1,85 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from MieRainbow import MieRainbow
+from ParallelMap import ParallelMap
+
+class MieRainbowBatch:
+    """ batch of MieRainbow objects for arrays of m and x,
+    constructed and evaluated by thread pool.
+    riccati_bessel (ctypes) and large numpy operations
+    (ufuncs and np.dot) release the GIL, so that threads
+    run in parallel without pickling of process pool.
+    angular functions are computed once for the largest x
+    and shared read-only by all objects through MieRainbow.cache
+    (see MieRainbow for thread safety)
+    """
+    def __init__(self, m, x, ord_max=None, executor='thread', workers=None):
+        """
+        m: float, scalar or array
+          refractive index of raindrop
+        x: float, scalar or array
+          2pi*(radius of raindrop)/(wavelength of light)
+          m and x are broadcast to common shape
+        ord_max: int, scalar
+          passed to MieRainbow.__init__()
+        executor: string or instance of ThreadPoolExecutor
+          'thread' (thread pool of workers is created for
+          each call), None (serial), or thread pool
+        workers: int, scalar
+          number of threads (default of ThreadPoolExecutor)
+        """
+        if(executor not in ('thread', None) and
+           not isinstance(executor, ThreadPoolExecutor)):
+            raise RuntimeError('executor must be thread pool')
+        m,x = np.broadcast_arrays(m, x)
+        self.shape = m.shape
+        self.executor = executor
+        self.workers = workers
+        # largest first for load balancing and sharing of basis
+        self.index = np.argsort(-x, axis=None, kind='stable')
+        r = self.map(MieRainbow, [(m.flat[k], x.flat[k], ord_max)
+                                  for k in self.index])
+        self.rbow = [None]*m.size # in order of flattened m,x
+        for k,r in zip(self.index, r): self.rbow[k] = r
+
+    def map(self, func, args):
+        """ func(*a) for a in args by thread pool """
+        return ParallelMap(func, args, self.executor, self.workers)
+
+    def evaluate(self, method, *args, **kw):
+        """ call method of all objects
+        method: string
+          name of method of MieRainbow
+          (e.g. 'intensity', 'averaged_intensity')
+        args, kw: arguments passed to method
+        return: r
+          r: list of results in order of flattened m,x
+        comment: object of largest x is evaluated first in
+          calling thread so that angular functions of largest
+          order are cached, and other objects use their leading
+          columns (read-only views) instead of computing them
+          in each thread
+        """
+        k = self.index
+        r = [getattr(self.rbow[k[0]], method)(*args, **kw)]
+        f = lambda k: getattr(self.rbow[k], method)(*args, **kw)
+        r += self.map(f, [(k,) for k in k[1:]])
+        s = [None]*len(k)
+        for k,r in zip(k,r): s[k] = r
+        return s
+
+    def intensity(self, theta, order=None, pol=0, **kw):
+        """ see MieRainbow.intensity for arguments
+        return: I
+          I: float, shape self.shape + np.shape(theta)
+        """
+        I = self.evaluate('intensity', theta, order, pol, **kw)
+        return np.reshape(I, self.shape + np.shape(theta))
+
+    def averaged_intensity(self, theta, order=None, pol=0, **kw):
+        """ see Rainbow.averaged_intensity for arguments
+        return: I
+          I: float, shape self.shape + np.shape(theta)
+        """
+        I = self.evaluate('averaged_intensity', theta, order, pol, **kw)
+        return np.reshape(I, self.shape + np.shape(theta))
@@ -0,0 +1,76 @@
+import numpy as np
+import sys
+from concurrent.futures import (Executor, ThreadPoolExecutor,
+                                ProcessPoolExecutor)
+from multiprocessing import shared_memory, resource_tracker
+
+def ParallelMap(func, args, executor=None, workers=None, **kw):
+    """ evaluate func(*a, **kw) for a in args, possibly in parallel
+    func: function
+      must be picklable (defined at module level)
+      if executor is process pool
+    args: list of tuples
+      positional arguments of func for each evaluation
+    executor: string or instance of concurrent.futures.Executor
+      'thread' for thread pool, 'process' for process pool.
+      if None, evaluations are performed serially
+      (or by thread pool if workers is given)
+    workers: int, scalar
+      number of workers of the pool created by this function
+    kw: dictionary
+      keyword arguments passed to func
+    return: r
+      r: list of func(*a, **kw) in the same order as args
+    comment: results of process pool are returned
+      through shared memory to avoid pickling large arrays
+    """
+    if executor is None and workers is None:
+        return [func(*a, **kw) for a in args]
+    if executor is None or executor == 'thread':
+        with ThreadPoolExecutor(workers) as e:
+            return ParallelMap(func, args, e, **kw)
+    if executor == 'process':
+        with ProcessPoolExecutor(workers) as e:
+            return ParallelMap(func, args, e, **kw)
+    if not isinstance(executor, Executor):
+        raise RuntimeError('bad executor')
+
+    if isinstance(executor, ProcessPoolExecutor):
+        f = [executor.submit(_shm_call, func, a, kw) for a in args]
+        r = []
+        try:
+            for g in f: r.append(_shm_load(*g.result()))
+        finally: # on error, release shared memory of other results
+            if len(r) < len(f):
+                for g in f: g.cancel()
+                for g in f[len(r):]:
+                    try: _shm_load(*g.result())
+                    except BaseException: pass
+        return r
+    else:
+        f = [executor.submit(func, *a, **kw) for a in args]
+        return [f.result() for f in f]
+
+def _shm_call(func, args, kw):
+    """ evaluate func in worker process and
+    write result to shared memory """
+    r = np.asarray(func(*args, **kw))
+    size = max(1, r.nbytes)
+    # parent process is responsible for unlink, so that
+    # shm must not be tracked (and unlinked) by this process
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(create=True, size=size, track=False)
+    else: # no track option; tracker is keyed by private _name
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    np.ndarray(r.shape, r.dtype, shm.buf)[...] = r
+    shm.close()
+    return shm.name, r.shape, r.dtype.str
+
+def _shm_load(name, shape, dtype):
+    """ copy result from shared memory and release it """
+    shm = shared_memory.SharedMemory(name)
+    r = np.array(np.ndarray(shape, dtype, shm.buf))
+    shm.close()
+    shm.unlink()
+    return r
@@ -1,53 +1,146 @@
 import numpy as np
-from scipy.optimize import newton
 from scipy.constants import arcsec
+from scipy.signal import oaconvolve
+from scipy.interpolate import CubicSpline, interp1d
+from functools import lru_cache
+from copy import copy
+from AdaptiveSampling import AdaptiveSampling
+from Counters import clock, record, hit, register_cache
 
 class Rainbow:
     """ Descartes theory of geometric optics """
     def __init__(self, m):
         """
-        m: float, scalar
+        m: float, scalar or array
           refractive index of raindrop
+          if m is array, object represents a batch of raindrops
+          and intensity is broadcast over m and theta
+          (see RainbowBatch.py)
         """
+        k = np.reshape([3,8], (2,) + (1,)*np.ndim(m))
         # rainbow angle of incidence for primary and secondary
-        a = np.arccos(np.sqrt((m*m-1)/np.r_[3,8]))
+        a = np.arccos(np.sqrt((m*m-1)/k))
         # rainbow angle of refraction
         b = np.arcsin(np.sin(a)/m)
         # rainbow angle of scattering
-        r = np.r_[2*a[0] - 4*b[0] + np.pi,
-                  6*b[1] - 2*a[1]]
+        r = np.array([2*a[0] - 4*b[0] + np.pi,
+                      6*b[1] - 2*a[1]])
         # grazing incidence
-        g = np.r_[2*np.pi - 4*np.arcsin(1/m),
-                  6*np.arcsin(1/m) - np.pi]
+        g = np.array([2*np.pi - 4*np.arcsin(1/m),
+                      6*np.arcsin(1/m) - np.pi])
         self.m = m
         self.alpha_r = a
         self.beta_r = b
         self.theta_r = r
         self.theta_g = g
+        self.alpha_map = {} # inverse of theta(alpha) (see incidence_map)
 
-    def angle_of_incidence(self, theta, order, alpha=0):
+    def angle_of_incidence(self, theta, order, alpha=0,
+                           tol=1.48e-8, maxiter=50):
         """
-        theta: float, scalar
+        theta: float, any shape
           angle between sun and raindrop / radian
           assume 0 <= theta <= pi
         order: int, scalar
           primary or secondary (1 or 2)
-        alpha: float, scalar
+        alpha: float, scalar or same shape as theta
           initial guess for the angle of incidence / radian
+        tol: float, scalar
+          convergence criterion for newton step / radian
+        maxiter: int, scalar
+          maximum number of newton iterations
         return: alpha
-          alpha: float, scalar
+          alpha: float, same shape as theta
             angle of incidence / radian
+        comment: newton iteration is performed on all elements
+          of theta at once, and each element stops when
+          its step becomes smaller than tol (as in scipy newton)
         """
-        if   order==1: beta = lambda x: (2*x + np.pi - theta)/4
-        elif order==2: beta = lambda x: (2*x + theta)/6
+        if   order==1: beta = lambda x,t: (2*x + np.pi - t)/4
+        elif order==2: beta = lambda x,t: (2*x + t)/6
         else: raise RuntimeError("bad order")
         d_beta = 1/(order+1)
-        return newton(lambda x: np.sin(x) - self.m*np.sin(beta(x)), alpha,
-                      lambda x: np.cos(x) - self.m*np.cos(beta(x))*d_beta)
+        t0 = clock()
+        t = np.asarray(theta, dtype=float)
+        x = np.array(np.broadcast_to(alpha, t.shape), dtype=float)
+        m = np.broadcast_to(self.m, t.shape).reshape(-1)
+        t,x = t.reshape(-1), x.reshape(-1) # x is a copy
+        i = np.arange(x.size) # elements not yet converged
+        steps = 0 # number of newton steps on elements
+        k = -1 # number of iterations is k+1
+        for k in range(maxiter):
+            steps += i.size
+            b = beta(x[i], t[i])
+            f = np.sin(x[i]) - m[i]*np.sin(b)
+            df = np.cos(x[i]) - m[i]*np.cos(b)*d_beta
+            j = (f!=0) & (df!=0) # else stop iteration
+            i,f,df = i[j], f[j], df[j]
+            dx = f/df
+            x[i] -= dx
+            i = i[np.abs(dx) > tol]
+            if i.size==0: break
+        else: raise RuntimeError("newton iteration failed to converge")
+        record('Rainbow.newton_iteration', None, steps, k+1)
+        record('Rainbow.angle_of_incidence', t0, x.size)
+        return x.reshape(np.shape(theta))[()]
+
+    def incidence_map(self, order, branch, tol=1e-12):
+        """ interpolation table of inverse function of theta(alpha)
+        order: int, scalar
+          primary or secondary (1 or 2)
+        branch: int, scalar
+          0 for alpha < alpha_r (ray found from initial guess 0)
+          1 for alpha > alpha_r (ray found from initial guess pi/2)
+        tol: float, scalar
+          tolerance of interpolation error of alpha / radian
+        return: f
+          f: function such that alpha = f(theta)
+            theta, alpha: float, any shape
+            angle between sun and raindrop, angle of incidence
+        comment: alpha is interpolated by cubic spline as a
+          function of s = sqrt|theta - theta_r|, so that it is
+          smooth at rainbow angle. number of nodes is doubled
+          until error at midpoints is less than tol.
+          f is computed once and saved in self.alpha_map.
+          if self is batch object, f solves for alpha by
+          angle_of_incidence() instead of interpolation.
+        """
+        if np.ndim(self.m): # batch object (no interpolation)
+            a = (0, np.pi/2)[branch]
+            return lambda t: self.angle_of_incidence(t, order, a)
+
+        key = (order, branch, tol)
+        hit('Rainbow.alpha_map', key in self.alpha_map)
+        if key in self.alpha_map: return self.alpha_map[key]
+        t0 = clock()
+
+        beta = lambda x: np.arcsin(np.sin(x)/self.m)
+        if   order==1: theta = lambda x: 2*x - 4*beta(x) + np.pi
+        elif order==2: theta = lambda x: 6*beta(x) - 2*x
+        else: raise RuntimeError("bad order")
+        t_r = self.theta_r[order-1]
+        a_r = self.alpha_r[order-1]
+        s = lambda x: np.sqrt(np.abs(theta(x) - t_r))
+        if   branch==0: a = (0, a_r)
+        elif branch==1: a = (np.pi/2, a_r) # s in increasing order
+        else: raise RuntimeError("bad branch")
+
+        N = 64
+        while True:
+            x = np.linspace(a[1], a[0], N+1)
+            g = CubicSpline(s(x), x)
+            x = (x[1:] + x[:-1])/2
+            if np.max(np.abs(g(s(x)) - x)) < tol or N >= 2**16: break
+            N *= 2
+
+        f = lambda t: g(np.sqrt(np.abs(np.asarray(t) - t_r)))[()]
+        self.alpha_map[key] = f
+        record('Rainbow.incidence_map', t0, N+1)
+        return f
 
     def ray_intensity(self, alpha, order, pol):
         """
-        alpha: float, scalar
+        alpha: float, any shape
           angle of incidence / radian
         order: int, scalar
           primary or secondary (1 or 2)
@@ -57,7 +150,7 @@ class Rainbow:
           1 for perpendicular polarization
           2 for parallel polarization
         return: I
-          I: float, scalar
+          I: float, same shape as alpha
             intensity of outgoing ray
         """
         beta = np.arcsin(np.sin(alpha)/self.m)
@@ -72,11 +165,30 @@ class Rainbow:
         elif pol==2:# Fresnel formula for parallel polarization
             R = np.tan(beta-alpha)/np.tan(alpha+beta)
         elif pol==0:
-            R = np.r_[np.sin(alpha-beta)/np.sin(alpha+beta),
-                      np.tan(beta-alpha)/np.tan(alpha+beta)]
-        e = np.mean((R**order * (1 - R**2))**2)
+            R = np.array([np.sin(alpha-beta)/np.sin(alpha+beta),
+                          np.tan(beta-alpha)/np.tan(alpha+beta)])
+        else: raise RuntimeError("bad polarization")
+        e = (R**order * (1 - R**2))**2
+        if pol==0: e = np.mean(e, axis=0)
         return e * np.sin(2*alpha)/2/np.sin(gamma)/np.abs(dg_da)
 
+    def masked(self, i):
+        """
+        i: bool, any shape
+          mask on the grid of theta
+        return: r
+          r: shallow copy of self whose m (and x if any) are
+            broadcast to i.shape and restricted to i,
+            so that r.m is aligned with theta[i].
+            if m is scalar, r is self
+        """
+        if np.ndim(self.m)==0: return self
+        r = copy(self)
+        r.m = np.broadcast_to(self.m, i.shape)[i]
+        if hasattr(self, 'x'):
+            r.x = np.broadcast_to(self.x, i.shape)[i]
+        return r
+
     def intensity(self, theta, order=None, pol=0):
         """
         theta: float, any shape
@@ -90,43 +202,65 @@ class Rainbow:
         return: I
           I: float, same shape as theta
             sum of intensities of two rays (if two exist)
+            if self is batch object, I.shape is broadcast
+            of m.shape and theta.shape
         """
         if order is None:
             return (self.intensity(theta, 1, pol) +
                     self.intensity(theta, 2, pol))
 
-        if not np.isscalar(theta): # vectorize
-            t = np.asarray(theta)
-            I = [self._intensity(t, order, pol) for t in t.flat]
-            return np.reshape(I, t.shape)
-
-        return self._intensity(theta, order, pol)
-
-    def _intensity(self, theta, order, pol):
-        """ same as self.intensity() except that
-        theta is scalar and order=1,2 """
+        t0 = clock()
+        t = np.asarray(theta, dtype=float)
+        t = np.broadcast_to(t, np.broadcast(t, self.theta_r[0]).shape)
+        I = np.zeros(t.shape)
         # Alexander's dark band
-        if((order==1 and theta <= self.theta_r[0]) or
-           (order==2 and theta >= self.theta_r[1])): return 0
+        if   order==1: i = t > self.theta_r[0]
+        elif order==2: i = t < self.theta_r[1]
+        else: raise RuntimeError("bad order")
 
-        alpha = self.angle_of_incidence(theta, order)
-        I = self.ray_intensity(alpha, order, pol)
+        r = self.masked(i)
+        alpha = r.incidence_map(order, 0)(t[i])
+        I[i] = r.ray_intensity(alpha, order, pol)
 
         # additional ray
-        if((order==1 and theta <= self.theta_g[0]) or
-           (order==2 and theta >= self.theta_g[1])):
-            alpha = self.angle_of_incidence(theta, order, np.pi/2)
-            I += self.ray_intensity(alpha, order, pol)
+        if order==1: i &= (t <= self.theta_g[0])
+        else:        i &= (t >= self.theta_g[1])
+        r = self.masked(i)
+        alpha = r.incidence_map(order, 1)(t[i])
+        I[i] += r.ray_intensity(alpha, order, pol)
 
-        return I
+        record('Rainbow.intensity', t0, t.size)
+        return I[()]
 
     SUN_RADIUS = 1919/2*arcsec # radian
 
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def disk_kernel(r, dx):
+        """ weight of averaging over disk of radius r
+        r: float, scalar
+          radius of source (of disk shape) / radian
+        dx: float, scalar
+          step size of integration
+        return: w
+          w: float, 1d-array (length 2*floor(r/dx) + 1)
+            half chord length of the disk at x = dx*(-M...M).
+            w is cached and read-only
+        """
+        M = int(np.floor(r/dx))
+        x = dx*np.arange(-M, M+1)
+        w = np.sqrt(r**2 - x**2)
+        w.flags.writeable = False
+        return w
+
     def averaged_intensity(self, theta, order=None, pol=0,
-                           r=SUN_RADIUS, dx=1e-3):
+                           r=SUN_RADIUS, dx=1e-3, tol=None, **kw):
         """ intensity averaged over finite source size
         theta: float, scalar or 1d-array
           angle between sun and raindrop / radian
+          if theta is not linspace, it must be in increasing
+          order, and averaged intensity is computed on uniform
+          grid of step size dx and interpolated to theta
         order: int, scalar
           primary or secondary (1 or 2)
         pol: int, scalar
@@ -136,28 +270,72 @@ class Rainbow:
           if r<dx, averaging is not performed
         dx: float, scalar
           step size of integration
+        tol: float, scalar
+          used only if r<dx (point source). if not None,
+          intensity is computed only on theta chosen
+          adaptively (seeded by theta_r) so that error of
+          linear interpolation is less than tol*max(I),
+          and interpolated on other theta (see
+          AdaptiveSampling.py). theta must be in
+          increasing order. effective for smooth profiles
+          (Airy and Young), not for Mie intensity which
+          has ripple of short period
+        kw: dictionary
+          keyword arguments passed to self.intensity()
         return: I
           I: float, same shape as theta
             averaged intensity
+            if self is batch object, I.shape = m.shape + theta.shape
+            where m.shape is without trailing axis of length 1
         """
-        if r<dx: return self.intensity(theta, order ,pol)
+        t0 = clock()
+        if r<dx:
+            if tol is None or np.size(theta) < 3:
+                I = self.intensity(theta, order, pol, **kw)
+            else:
+                t = np.asarray(theta)
+                f = lambda k: self.intensity(t[k], order, pol, **kw)
+                I = AdaptiveSampling(f, t, tol, self.theta_r)
+            record('Rainbow.averaged_intensity', t0, np.size(I))
+            return I
 
-        if not np.isscalar(theta):
+        if np.size(theta) > 1:
             dt = np.diff(theta)
-            if not np.allclose(dt, dt[0]):
-                raise RuntimeError('theta is not linspace')
-            N = int(np.ceil(dt[0]/dx))
-            dx = dt[0]/N
-            t = np.linspace(theta[0], theta[-1], N*len(dt) + 1)
-        else: t = [theta]
+            if np.allclose(dt, dt[0]):
+                N = int(np.ceil(dt[0]/dx))
+                dx = dt[0]/N
+                t = np.linspace(theta[0], theta[-1], N*len(dt) + 1)
+            elif np.all(dt > 0): # resample on uniform grid
+                N = int(np.ceil((theta[-1] - theta[0])/dx))
+                dx = (theta[-1] - theta[0])/N
+                t = np.linspace(theta[0], theta[-1], N+1)
+                N = None
+            else:
+                raise RuntimeError('theta is not in increasing order')
+        else: t,N = np.reshape(theta, -1),1
 
-        M = int(np.floor(r/dx))
-        r2 = r**2
+        w = self.disk_kernel(r, dx)
+        M = len(w)//2
         x = dx*np.arange(-M, M+1)
-        w = np.sqrt(r2 - x**2)
-        t = np.r_[t[0] + x[:M], t, t[-1] + x[M+1:]]
-        I = self.intensity(t, order, pol)
-        I = np.convolve(I, w, 'valid') # fast averaging by convolution
-        if not np.isscalar(theta): I = I[::N]
-        else: I = np.squeeze(I)
-        return I*dx*2/np.pi/r2
+        u = np.r_[t[0] + x[:M], t, t[-1] + x[M+1:]]
+        I = self.intensity(u, order, pol, **kw)
+        t1 = clock()
+        if len(w) >= 64: # fast averaging by fft
+            w = np.reshape(w, (1,)*(I.ndim-1) + (-1,))
+            I = oaconvolve(I, w, 'valid', axes=-1)
+            I = np.maximum(I, 0) # rounding error where I == 0
+        elif I.ndim==1: I = np.convolve(I, w, 'valid')
+        else: # direct convolution along last axis
+            n = I.shape[-1] - len(w) + 1
+            J = np.zeros(I.shape[:-1] + (n,))
+            for k,v in enumerate(w[::-1]): J += v*I[...,k:k+n]
+            I = J
+        record('Rainbow.convolve', t1, I.size)
+        if np.isscalar(theta): I = I[...,0]
+        elif N is None: I = interp1d(t, I, assume_sorted=True)(theta)
+        else: I = I[...,::N]
+        record('Rainbow.averaged_intensity', t0, I.size)
+        return I*dx*2/np.pi/r**2
+
+register_cache('Rainbow.disk_kernel',
+               lambda: Rainbow.disk_kernel.cache_info()[:2])
@@ -0,0 +1,25 @@
+import numpy as np
+from Rainbow import Rainbow
+from MieRainbow import MieRainbow
+
+def RainbowBatch(rbow, m, x=None):
+    """ batch of rainbow objects for arrays of m and x
+    rbow: Rainbow class (NOT Rainbow object)
+      either Rainbow, YoungRainbow or AiryRainbow
+    m: float, scalar or 1d-array
+      refractive index of raindrop
+    x: float, scalar or 1d-array
+      2pi*(radius of raindrop)/(wavelength of light)
+      if rbow == Rainbow (geometric optics), x is used
+      only for the shape of batch
+    return: r
+      r: object of class rbow, with m and x reshaped to
+        column vectors of common length K, so that
+        r.intensity(theta) and r.averaged_intensity(theta)
+        have shape (K, len(theta)) for 1d-array theta
+    """
+    if rbow == MieRainbow or not issubclass(rbow, Rainbow):
+        raise RuntimeError('rbow cannot be batched')
+    m,x = np.broadcast_arrays(m, 0 if x is None else x)
+    if rbow == Rainbow: return rbow(np.reshape(m, (-1,1)))
+    return rbow(np.reshape(m, (-1,1)), np.reshape(x, (-1,1)))
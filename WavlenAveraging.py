@@ -1,21 +1,30 @@
 import numpy as np
 from Rainbow import Rainbow
 from MieRainbow import MieRainbow
-from RGB import RGBFromWavlen
+from MieRainbowBatch import MieRainbowBatch
+from RainbowBatch import RainbowBatch
+from ParallelMap import ParallelMap
+from RGB import RGBFromWavlen, wavlen0, wavlen1
 from RefractiveIndex import IndexFromWavlen
 from BlackBody import BlackBody
+from numpy.polynomial.legendre import leggauss
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from Counters import clock, record, register_cache
 
 def WavlenAveraging(rbow, theta, a=None, RGB_ONLY=True,
                     wavlen=(380e-9, 700e-9), N_wavlen=16,
-                    T=5783, **kw):
+                    T=5783, quad_wavlen='uniform',
+                    executor=None, workers=None, **kw):
     """ average rainbow light over black-body spectrum
     rbow: Rainbow class (NOT Rainbow object)
       either Rainbow, YoungRainbow, AiryRainbow or MieRainbow
     theta: float, 1d-array
       angle between sun and raindrop / radian
-    a: float, scalar
+    a: float, scalar or 1d-array
       radius of waterdrop / m
       a is ignored if rbow == Rainbow (geometric optics)
+      if a is 1d-array, all radii are evaluated in one batch
     RGB_ONLY: bool, scalar
       if True, only RGB luminance is computed,
       if False, white light luminance is computed in 4-th component
@@ -25,6 +34,14 @@ def WavlenAveraging(rbow, theta, a=None, RGB_ONLY=True,
       number of averaging points
     T: float, scalar
       temperature of black-body spectrum / K
+    quad_wavlen: string
+      quadrature rule over wavelength (quad in SpectralWeights)
+    executor: string or instance of concurrent.futures.Executor
+      executor of MieRainbow evaluations (see ParallelMap.py)
+      for all pairs of radius and wavelength.
+      if thread pool, see MieRainbowBatch.py
+    workers: int, scalar
+      number of workers (see ParallelMap.py)
     kw: dictionary
       keyword arguments passed to Rainbow.averaged_intensity()
       except that kw['ord_max'] is passed to MieRainbow.__init__()
@@ -33,26 +50,129 @@ def WavlenAveraging(rbow, theta, a=None, RGB_ONLY=True,
         I[0,1,2] is R,G,B luminance.
         if RGB_ONLY is False, I[3] is white light luminance.
         0 <= I <= 1
+        if a is 1d-array, shape(len(a), 3 or 4, len(theta))
     """
-    wavlen = np.linspace(wavlen[0], wavlen[1], N_wavlen)
-    m = IndexFromWavlen(wavlen)
+    t0 = clock()
+    wavlen,m,W = SpectralWeights(wavlen, N_wavlen, T, quad_wavlen)
     if rbow == Rainbow:
-        r = [rbow(m) for m in m]
-    elif issubclass(rbow, Rainbow):
-        x = 2*np.pi*a/wavlen
-        if rbow == MieRainbow and 'ord_max' in kw:
-            ord_max = kw.pop('ord_max')
-            r = [rbow(m, x, ord_max) for m,x in zip(m,x)]
+        I = RainbowBatch(rbow, m).averaged_intensity(theta, **kw)
+        I = np.broadcast_to(I, np.shape(a) + I.shape)
+    else:
+        x = 2*np.pi*np.reshape(a, (-1,1))/wavlen # (len(a), N_wavlen)
+        m = np.broadcast_to(m, x.shape).reshape(-1)
+        x = x.reshape(-1)
+        if rbow == MieRainbow:
+            I = MieAveragedIntensity(m, x, theta, executor, workers, **kw)
+        elif issubclass(rbow, Rainbow):
+            I = RainbowBatch(rbow, m, x).averaged_intensity(theta, **kw)
         else:
-            r = [rbow(m,x) for m,x in zip(m,x)]
+            raise RuntimeError('rbow is not Rainbow')
+        I = np.reshape(I, np.shape(a) + (N_wavlen, -1))
+
+    if RGB_ONLY: W = W[:3]
+    I = np.einsum('ji,...ik', W,I)
+    record('WavlenAveraging', t0, I.size)
+    return I
+
+def SpectralWeights(wavlen=(380e-9, 700e-9), N_wavlen=16,
+                    T=5783, quad='uniform'):
+    """ quadrature of black-body spectrum times RGB luminance
+    wavlen: float, tuple
+      wavelength range of averaging / m
+    N_wavlen: int, scalar
+      number of averaging points
+    T: float, scalar
+      temperature of black-body spectrum / K
+    quad: string
+      'uniform': uniform points with equal weights
+      'gauss': Gauss-Legendre rule on sub-bands separated by
+        break points of RGBFromWavlen (where the integrand
+        is not smooth). N_wavlen is divided in proportion
+        to widths of sub-bands (at least one point each).
+        for N_wavlen >= 12, typically as accurate as
+        'uniform' with twice as many points
+    return: wavlen, m, W
+      wavlen: float, 1d-array of length N_wavlen
+        wavelengths of averaging points / m
+      m: float, 1d-array of length N_wavlen
+        refractive index at wavlen
+      W: float, shape (4, N_wavlen)
+        weights of R,G,B and white light luminance, such that
+        np.dot(W, I) is averaged luminance when I is
+        intensity at wavlen
+    comment: arrays are cached for each argument
+      and returned as read-only
+    """
+    return _spectral_weights(tuple(wavlen), N_wavlen, T, quad)
+
+@lru_cache
+def _spectral_weights(wavlen, N, T, quad):
+    """ cached body of SpectralWeights """
+    w0,w1 = wavlen
+    if quad == 'uniform':
+        x = np.linspace(w0, w1, N)
+        w = np.ones(N)
+    elif quad == 'gauss':
+        e = np.unique(np.r_[wavlen0, wavlen1])
+        e = np.r_[w0, e[(e > w0) & (e < w1)], w1]
+        if N < len(e) - 1: e = np.array([w0, w1])
+        n = np.round((N - len(e) + 1)*(e - w0)/(w1 - w0))
+        n = 1 + np.diff(n).astype(int)
+        x,w = [],[]
+        for e0,e1,n in zip(e[:-1], e[1:], n):
+            y,v = leggauss(n)
+            x.append((e0 + e1)/2 + (e1 - e0)/2*y)
+            w.append((e1 - e0)/2*v)
+        x,w = np.concatenate(x), np.concatenate(w)
     else:
-        raise RuntimeError('rbow is not Rainbow')
+        raise RuntimeError('bad quad')
+
+    S = w*BlackBody(x, T)/x
+    W = np.vstack((RGBFromWavlen(x)*S, S))/np.sum(S)
+    m = IndexFromWavlen(x)
+    for a in (x,m,W): a.flags.writeable = False
+    return x,m,W
 
-    I = [r.averaged_intensity(theta, **kw) for r in r]
-    S = BlackBody(wavlen, T)/wavlen
-    s = np.sum(S)
-    RGB = RGBFromWavlen(wavlen)
-    i = np.einsum('ji,i,ik', RGB,S,I)/s
+register_cache('SpectralWeights', lambda: _spectral_weights.cache_info()[:2])
 
-    if RGB_ONLY: return i
-    else: return np.vstack((i, np.dot(S,I)/s))
+def MieAveragedIntensity(m, x, theta, executor=None, workers=None,
+                         ord_max=None, **kw):
+    """ averaged intensity of MieRainbow objects
+    m,x: float, 1d-arrays (of the same length)
+      arguments passed to MieRainbow.__init__()
+    theta: float, 1d-array
+      angle between sun and raindrop / radian
+    executor, workers: see ParallelMap.py
+      if thread pool is used, objects are constructed and
+      evaluated by MieRainbowBatch (sharing angular functions)
+    ord_max: int, scalar
+      maximum order of Debye series passed to MieRainbow.__init__()
+    kw: dictionary
+      keyword arguments passed to averaged_intensity()
+    return: I
+      I: float, shape(len(m), len(theta))
+    """
+    if(executor == 'thread' or isinstance(executor, ThreadPoolExecutor)
+       or executor is None and workers is not None):
+        r = MieRainbowBatch(m, x, ord_max, executor or 'thread', workers)
+        return r.averaged_intensity(theta, **kw)
+    return np.array(ParallelMap(AveragedIntensity,
+                                [(MieRainbow, m, x, theta)
+                                 for m,x in zip(m,x)],
+                                executor, workers, ord_max=ord_max, **kw))
+
+def AveragedIntensity(rbow, m, x, theta, ord_max=None, **kw):
+    """ averaged intensity of single rainbow object
+    rbow: MieRainbow class (NOT MieRainbow object)
+    m,x: float, scalars
+      arguments passed to rbow.__init__()
+    theta: float, 1d-array
+      angle between sun and raindrop / radian
+    ord_max: int, scalar
+      maximum order of Debye series passed to rbow.__init__()
+    kw: dictionary
+      keyword arguments passed to rbow.averaged_intensity()
+    return: I
+      I: float, shape(len(theta),)
+    """
+    return rbow(m, x, ord_max).averaged_intensity(theta, **kw)
@@ -1,26 +1,29 @@
 import numpy as np
 from Rainbow import Rainbow
+from Counters import clock, record
 
 class YoungRainbow(Rainbow):
     """ Young theory of interference """
     def __init__(self, m, x):
         """
-        m: float, scalar
+        m: float, scalar or array
           refractive index of raindrop
-        x: float, scalar
+        x: float, scalar or array
           2pi * (radius of raindrop)/(wavelength of lignt)
+          if m or x is array, object represents a batch of
+          raindrops (see RainbowBatch.py)
         """
         super().__init__(m)
         self.x = x
 
     def phase(self, alpha, order):
         """
-        alpha: float, scalar
+        alpha: float, any shape
           angle of incidence / radian
         order: int, scalar
           primary or secondary (1 or 2)
         return: phi
-          phi: float, scalar
+          phi: float, same shape as alpha
             optical path length / radian
             (up to additive const)
         """
@@ -29,7 +32,7 @@ class YoungRainbow(Rainbow):
 
     def ray_amplitude(self, alpha, order, pol):
         """
-        alpha: float, scalar
+        alpha: float, any shape
           angle of incidence / radian
         order: int, scalar
           primary or secondary (1 or 2)
@@ -39,8 +42,8 @@ class YoungRainbow(Rainbow):
           1 for perpendicular polarization
           2 for parallel polarization
         return: A
-          A: complex, scalar if pol==1 or 2,
-                      1d-array if pol==0
+          A: complex, same shape as alpha if pol==1 or 2,
+                      shape (2,) + alpha.shape if pol==0
             amplitude of outgoing ray.
             if pol==0, A[0] and A[1] are for pependicular and
             parallel polarizaions, respectively
@@ -57,14 +60,14 @@ class YoungRainbow(Rainbow):
         elif pol==2:# Fresnel formula for parallel polarization
             R = np.tan(beta-alpha)/np.tan(alpha+beta)
         elif pol==0:
-            R = np.r_[np.sin(alpha-beta)/np.sin(alpha+beta),
-                      np.tan(beta-alpha)/np.tan(alpha+beta)]
+            R = np.array([np.sin(alpha-beta)/np.sin(alpha+beta),
+                          np.tan(beta-alpha)/np.tan(alpha+beta)])
         else: raise RuntimeError("bad polarization")
 
         e = R**order * (1 - R**2)
         A = np.sin(2*alpha)/2/np.sin(gamma)/dg_da
         p = self.phase(alpha, order)
-        return e*np.sqrt(complex(A))*np.exp(1j*p)
+        return e*np.sqrt(A + 0j)*np.exp(1j*p)
 
     def intensity(self, theta, order=None, pol=0):
         """
@@ -86,26 +89,28 @@ class YoungRainbow(Rainbow):
             return (self.intensity(theta, 1, pol) +
                     self.intensity(theta, 2, pol)) 
 
-        if not np.isscalar(theta): # vectorize
-            t = np.asarray(theta)
-            I = [self._intensity(t, order, pol) for t in t.flat]
-            return np.reshape(I, t.shape)
-
-        return self._intensity(theta, order, pol)
+        t0 = clock()
+        t = np.asarray(theta, dtype=float)
+        t = np.broadcast_to(t, np.broadcast(t, self.theta_r[0], self.x).shape)
+        I = np.zeros(t.shape)
+        # Alexander's dark band and additional ray
+        if order==1:
+            i = t > self.theta_r[0]
+            j = (t <= self.theta_g[0])[i]
+        elif order==2:
+            i = t < self.theta_r[1]
+            j = (t >= self.theta_g[1])[i]
+        else: raise RuntimeError("bad order")
 
-    def _intensity(self, theta, order, pol):
-        """ same as self.intensity() except that
-        theta is scalar and order=1,2 """
-        if((order==1 and theta <= self.theta_r[0]) or
-           (order==2 and theta >= self.theta_r[1])): return 0
-        
-        alpha = self.angle_of_incidence(theta, order)
-        A = self.ray_amplitude(alpha, order, pol)
-        if ((order==1 and theta <= self.theta_g[0]) or
-            (order==2 and theta >= self.theta_g[1])):
-            alpha = self.angle_of_incidence(theta, order, np.pi/2)
-            A += self.ray_amplitude(alpha, order, pol)
+        r = self.masked(i)
+        alpha = r.incidence_map(order, 0)(t[i])
+        A = r.ray_amplitude(alpha, order, pol)
+        r = r.masked(j)
+        alpha = r.incidence_map(order, 1)(t[i][j])
+        A[...,j] += r.ray_amplitude(alpha, order, pol)
 
         A = np.abs(A)**2
-        if pol==0: return np.mean(A)
-        else: return A
+        if pol==0: A = np.mean(A, axis=0)
+        I[i] = A
+        record('YoungRainbow.intensity', t0, t.size)
+        return I[()]
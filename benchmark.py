@@ -0,0 +1,215 @@
+# benchmark of models and drivers
+# usage:
+#   python benchmark.py [-o result.json] [-b baseline.json]
+#                       [-k name] [--quick] [--threshold 1.25]
+#   with -b, results are compared with baseline
+#   (saved by earlier run with -o), and exit status is 1
+#   if time or peak memory increased more than threshold
+
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import scipy
+from scipy.constants import degree
+from Rainbow import Rainbow
+from YoungRainbow import YoungRainbow
+from AiryRainbow import AiryRainbow
+from MieRainbow import MieRainbow, angular_functions
+from riccati_jn import riccati_jn, riccati_bessel
+from WavlenAveraging import WavlenAveraging
+from DropsizeAveraging import DropsizeAveraging
+from LeeDiagram import LeeDiagram
+from LavenDiagram import LavenDiagram
+try: from scipy.special import lpmn # removed in later scipy
+except ImportError: lpmn = None
+
+theta = lambda N: np.linspace(2.2, 2.5, N)
+order = lambda x: int(x + 4*x**(1/3) + 2.5) # as in MieRainbow
+
+def model(rbow, N_theta, *args):
+    """ intensity of rainbow object (including construction) """
+    return lambda: rbow(1.333, *args).intensity(theta(N_theta))
+
+def mie_amplitude(x, N_theta, ord_max=None):
+    """ MieRainbow.scattering_amplitude without angular cache """
+    r = MieRainbow(1.333, x, ord_max)
+    order = None if ord_max is None else [1,2]
+    def f():
+        MieRainbow.cache.clear()
+        r.scattering_amplitude(theta(N_theta), order)
+    return f
+
+def lpmn_angular(theta, n):
+    """ pi_n and tau_n by lpmn for each angle (replaced by
+    angular_functions, kept as reference of benchmark) """
+    c,s = np.cos(theta), np.sin(theta)
+    P = np.array([lpmn(1, n, c) for c in c])[:,:,1,1:]
+    return P[:,0]/s[:,None], -P[:,1]*s[:,None]
+
+def lee(rbow, H, W, **kw):
+    """ Lee diagram of fig17 reduced to H x W pixels """
+    t = np.linspace(124, 143, (W-1)//6*19 + 1)*degree
+    a = np.geomspace(1e-5, 1e-3, H)
+    return lambda: LeeDiagram(rbow, t, a, **kw)
+
+def laven(rbow, a, W, N, **kw):
+    """ Laven diagram of fig19 reduced to width W """
+    phi, th1, th2 = 30*degree, 42*degree, 51*degree
+    x = th1*np.sin(phi)
+    return lambda: LavenDiagram(rbow, a, 0, x, th1*np.cos(phi), th2,
+                                W, N, **kw)
+
+# name -> list of (params, function returning callable to be timed)
+CASES = {
+    'Rainbow.intensity': [
+        ({'N_theta': N}, lambda N=N: model(Rainbow, N))
+        for N in (1000, 10000, 100000)],
+    'YoungRainbow.intensity': [
+        ({'N_theta': N, 'x': 1000}, lambda N=N: model(YoungRainbow, N, 1000))
+        for N in (1000, 10000, 100000)],
+    'AiryRainbow.intensity': [
+        ({'N_theta': N, 'x': 1000}, lambda N=N: model(AiryRainbow, N, 1000))
+        for N in (1000, 10000, 100000)],
+    'MieRainbow.__init__': [
+        ({'x': x, 'ord_max': o}, lambda x=x, o=o: lambda: MieRainbow(1.333, x, o))
+        for x in (100, 1000, 10000) for o in (None, 4)],
+    'MieRainbow.scattering_amplitude': [
+        ({'x': x, 'N_theta': N, 'ord_max': o},
+         lambda x=x, N=N, o=o: mie_amplitude(x, N, o))
+        for x in (100, 1000) for N in (100, 1000) for o in (None, 4)],
+    'angular_functions': [
+        ({'x': x, 'N_theta': N},
+         lambda x=x, N=N: lambda: angular_functions(theta(N), order(x)))
+        for x in (1000, 2000) for N in (100, 500)],
+    'lpmn': [ # reference for angular_functions
+        ({'x': x, 'N_theta': N},
+         lambda x=x, N=N: lambda: lpmn_angular(theta(N), order(x)))
+        for x in (1000, 2000) for N in (100, 500)] if lpmn else [],
+    'riccati_jn': [
+        ({'x': x}, lambda x=x: lambda: riccati_jn(order(x), x))
+        for x in (1000, 10000, 100000)],
+    'riccati_bessel': [
+        ({'x': x}, lambda x=x: lambda: riccati_bessel(order(x), (x, 1.333*x)))
+        for x in (1000, 10000, 100000)],
+    'WavlenAveraging': [
+        ({'rbow': r.__name__, 'N_wavlen': N, 'N_theta': 300},
+         lambda r=r, N=N: lambda: WavlenAveraging(r, theta(300), 5e-5,
+                                                  N_wavlen=N))
+        for r in (AiryRainbow, MieRainbow) for N in (4, 16)],
+    'DropsizeAveraging': [
+        ({'rbow': r.__name__, 'N_dropsize': N, 'N_wavlen': 4},
+         lambda r=r, N=N: lambda: DropsizeAveraging(r, theta(300), 5e-5, 1e-5,
+                                                    N_dropsize=N, N_wavlen=4))
+        for r in (AiryRainbow, MieRainbow) for N in (4, 16)],
+    'LeeDiagram': [
+        ({'rbow': 'AiryRainbow', 'H': 16, 'W': 31},
+         lambda: lee(AiryRainbow, 16, 31))],
+    'LavenDiagram': [
+        ({'rbow': 'AiryRainbow', 'W': 64, 'N_theta': 256},
+         lambda: laven(AiryRainbow, [5e-4, 1e-4], 64, 256))],
+    # macro-benchmarks (reduced figures)
+    'fig17': [
+        ({'H': 4, 'W': 31, 'N_wavlen': 4},
+         lambda: lee(MieRainbow, 4, 31, N_wavlen=4))],
+    'fig18': [
+        ({'H': 4, 'W': 31, 'N_wavlen': 4, 'sigma': 0.5, 'h': 0.2},
+         lambda: lee(MieRainbow, 4, 31, sigma=0.5, h=0.2, N_wavlen=4))],
+    'fig19': [
+        ({'a': 5e-5, 'W': 32, 'N_theta': 64, 'N_wavlen': 4},
+         lambda: laven(MieRainbow, 5e-5, 32, 64, N_wavlen=4))],
+}
+
+QUICK = ('Rainbow', 'YoungRainbow', 'AiryRainbow', 'riccati',
+         'MieRainbow.__init__')
+
+def measure(f, repeat=3, min_time=0.2):
+    """
+    f: function without arguments
+    repeat: int, scalar
+      number of timed calls (at least)
+    min_time: float, scalar
+      calls are repeated until total time exceeds min_time / sec
+    return: t, peak
+      t: float, 1d-array, time of each call / sec
+      peak: int, scalar
+        peak memory allocated during a call / byte
+        (measured by tracemalloc in separate call)
+    """
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    t = []
+    while len(t) < repeat or sum(t) < min_time:
+        t0 = time.perf_counter()
+        f()
+        t.append(time.perf_counter() - t0)
+    return np.array(t), peak
+
+def run(pattern=None, quick=False, repeat=3):
+    """ run benchmarks whose name contains pattern
+    return: dictionary of results keyed by case name """
+    r = {}
+    for name, cases in CASES.items():
+        if pattern and pattern not in name: continue
+        if quick and not name.startswith(QUICK): continue
+        for p,setup in cases:
+            key = name + '(' + ','.join('%s=%s' % i for i in p.items()) + ')'
+            t,peak = measure(setup(), repeat)
+            r[key] = {'time': float(np.min(t)),
+                      'median': float(np.median(t)),
+                      'calls': len(t),
+                      'peak_bytes': int(peak),
+                      'params': p}
+            print('%-66s %10.4f s %10.1f MB' % (key, r[key]['time'], peak/2**20))
+            sys.stdout.flush()
+    return r
+
+def compare(result, baseline, threshold=1.25):
+    """ compare result with baseline
+    return: list of regressed case names """
+    bad = []
+    print('\n%-66s %8s %8s' % ('case', 'time', 'memory'))
+    for key, r in result.items():
+        b = baseline.get(key)
+        if b is None: continue
+        t = r['time']/b['time']
+        m = r['peak_bytes']/max(b['peak_bytes'], 1)
+        flag = t > threshold or m > threshold
+        if flag: bad.append(key)
+        print('%-66s %8.2f %8.2f %s' % (key, t, m, '<-- regression' if flag else ''))
+    return bad
+
+def main():
+    p = argparse.ArgumentParser(description='benchmark of rainbow models')
+    p.add_argument('-o', '--output', help='save results to json file')
+    p.add_argument('-b', '--baseline', help='compare with json file')
+    p.add_argument('-k', '--pattern', help='run cases containing pattern')
+    p.add_argument('--quick', action='store_true', help='models only')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--threshold', type=float, default=1.25,
+                   help='ratio to baseline regarded as regression')
+    args = p.parse_args()
+
+    result = run(args.pattern, args.quick, args.repeat)
+    if args.output:
+        meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'scipy': scipy.__version__}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': result}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(result, baseline, args.threshold): sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# headless runner of fig*.py scripts
+# usage:
+#   python make_figures.py [fig17 fig18 ...] [-o outdir] [-j workers]
+#                          [--cache dir] [--force]
+#   figures are computed in parallel worker processes and
+#   written to outdir as eps files without display.
+#   figure is skipped if its eps exists and neither the
+#   script nor the modules it depends on have changed.
+#   results of averaging and diagram functions and intensity
+#   profiles of rainbow objects are cached in cache directory
+#   (see CoefficientStore.py), so that changes in plotting
+#   code only do not recompute them
+
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+import numpy as np
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+NATIVE = {'riccati_jn': 'riccati_jn.c'} # module -> source of library
+
+# functions whose results are cached (module, attribute)
+# methods are cached with their object (see _arg_key)
+CACHED = [('WavlenAveraging', 'WavlenAveraging'),
+          ('DropsizeAveraging', 'DropsizeAveraging'),
+          ('LeeDiagram', 'LeeDiagram'),
+          ('LavenDiagram', 'LavenDiagram'),
+          ('Rainbow', 'Rainbow.intensity'),
+          ('Rainbow', 'Rainbow.averaged_intensity'),
+          ('YoungRainbow', 'YoungRainbow.intensity'),
+          ('AiryRainbow', 'AiryRainbow.intensity'),
+          ('MieRainbow', 'MieRainbow.intensity')]
+
+def dependencies(name):
+    """ local modules imported by module name (recursively)
+    name: string
+      module name (or script name without .py)
+    return: d
+      d: list of file names (including name.py itself)
+        in ROOT, sorted
+    """
+    d,stack = set(), [name]
+    pattern = re.compile(r'^\s*(?:from\s+(\w+)\s+import|import\s+(\w+))', re.M)
+    while stack:
+        f = stack.pop() + '.py'
+        if f in d or not os.path.exists(os.path.join(ROOT, f)): continue
+        d.add(f)
+        with open(os.path.join(ROOT, f)) as s:
+            stack += [a or b for a,b in pattern.findall(s.read())]
+        if f[:-3] in NATIVE: d.add(NATIVE[f[:-3]])
+    return sorted(d)
+
+def code_hash(*names):
+    """ return: sha1 of sources of dependencies of names """
+    h = sha1()
+    for f in sorted(set(sum(map(dependencies, names), []))):
+        h.update(f.encode())
+        with open(os.path.join(ROOT, f), 'rb') as s: h.update(s.read())
+    return h.hexdigest()
+
+def _arg_key(a):
+    """ string representing argument a of cached function """
+    if isinstance(a, type): # code of its module is not in code of func
+        return '%s.%s:%s' % (a.__module__, a.__qualname__,
+                             code_hash(a.__module__))
+    if isinstance(a, (list, tuple, np.ndarray)):
+        a = np.ascontiguousarray(a)
+        if a.dtype != object:
+            return '%s%s:%s' % (a.dtype.str, a.shape, sha1(a.data).hexdigest())
+        return '%s[%s]' % (a.shape, ','.join(map(_arg_key, a.flat)))
+    if isinstance(a, (float, np.floating)): return float(a).hex()
+    if hasattr(a, 'averaged_intensity'): # Rainbow object
+        # by arguments of constructor, since other attributes
+        # (e.g. alpha_map) are filled lazily by calls
+        v = [getattr(a, k, None) for k in ('m', 'x', 'ord_max')]
+        return _arg_key(type(a)) + '(' + ','.join(map(_arg_key, v)) + ')'
+    if isinstance(a, dict):
+        return '{' + ','.join(_arg_key(k) + ':' + _arg_key(a[k])
+                              for k in sorted(a)) + '}'
+    if hasattr(a, '__dict__'): # other objects by their state
+        # (repr contains address, which differs in every run)
+        return _arg_key(type(a)) + _arg_key(vars(a))
+    return repr(a)
+
+_depth = [0] # depth of nested calls of cached functions
+
+def cached(func, store, code):
+    """ function caching results of func in store
+    func: function
+      returns float array
+    store: CoefficientStore object
+    code: string
+      hash of code that func depends on
+    return: f
+      f: function with same arguments as func
+    comment: only outermost call is cached (e.g. WavlenAveraging
+      called by LeeDiagram is not cached separately)
+    """
+    def f(*args, **kw):
+        if _depth[0]: return func(*args, **kw)
+        key = [func.__name__, code] + [_arg_key(a) for a in args]
+        key += [k + '=' + _arg_key(kw[k]) for k in sorted(kw)]
+        key = store.key(*key)
+        c = store.load(key)
+        if c is not None: return np.array(c['I'])
+        _depth[0] += 1
+        try: I = func(*args, **kw)
+        finally: _depth[0] -= 1
+        if isinstance(I, np.ndarray): store.save(key, {'I': I})
+        return I
+    f.__name__ = func.__name__
+    f.__wrapped__ = func
+    return f
+
+def run(name, outdir, cache):
+    """ run script name.py headless (in worker process)
+    name: string
+      script name without .py (e.g. 'fig17')
+    outdir: string
+      directory of eps outputs
+    cache: string
+      directory of cached results (None for no cache)
+    return: t
+      t: float, scalar, time of execution / sec
+    """
+    import runpy
+    import importlib
+    import matplotlib
+    matplotlib.use('Agg') # no display
+    import matplotlib.pyplot as plt
+    from CoefficientStore import CoefficientStore
+
+    if ROOT not in sys.path: sys.path.insert(0, ROOT)
+    if cache is not None:
+        store = CoefficientStore(cache)
+        for m,f in CACHED: # replaced before script imports them
+            m = importlib.import_module(m)
+            *c,f = f.split('.')
+            c = getattr(m, c[0]) if c else m # class of method
+            g = getattr(c, f)
+            g = getattr(g, '__wrapped__', g) # worker is reused
+            setattr(c, f, cached(g, store, code_hash(m.__name__)))
+
+    saved = []
+    savefig, show = plt.savefig, plt.show
+    def save(f, *args, **kw): # write to outdir
+        f = os.path.join(outdir, os.path.basename(f))
+        saved.append(f)
+        savefig(f, *args, **kw)
+
+    t = time.perf_counter()
+    plt.savefig, plt.show = save, lambda *a, **k: None
+    try:
+        runpy.run_path(os.path.join(ROOT, name + '.py'), run_name='__main__')
+        if not saved: save(name + '.eps') # script without savefig
+    finally:
+        plt.savefig, plt.show = savefig, show
+        plt.close('all')
+    return time.perf_counter() - t
+
+def main():
+    p = argparse.ArgumentParser(description='headless runner of fig*.py')
+    p.add_argument('figs', nargs='*', help='figure names (default all)')
+    p.add_argument('-o', '--outdir', default='.', help='eps directory')
+    p.add_argument('-j', '--workers', type=int, help='number of processes')
+    p.add_argument('--cache', default=os.path.join(ROOT, '.figcache'),
+                   help='cache directory')
+    p.add_argument('--no-cache', action='store_true',
+                   help='do not cache intermediate results')
+    p.add_argument('-f', '--force', action='store_true',
+                   help='recompute all figures')
+    args = p.parse_args()
+
+    figs = args.figs or [os.path.basename(f)[:-3]
+                         for f in glob.glob(os.path.join(ROOT, 'fig*.py'))]
+    figs.sort(key=lambda f: int(f[3:]))
+    outdir = os.path.abspath(args.outdir)
+    os.makedirs(outdir, exist_ok=True)
+    cache = None if args.no_cache else os.path.abspath(args.cache)
+    manifest = os.path.join(outdir, 'figures.json')
+    try:
+        with open(manifest) as f: done = json.load(f)
+    except FileNotFoundError: done = {}
+
+    todo = {}
+    for name in figs:
+        h = code_hash(name)
+        eps = os.path.join(outdir, name + '.eps')
+        if not args.force and done.get(name) == h and os.path.exists(eps):
+            print('%-8s up to date' % name)
+        else: todo[name] = h
+
+    failed = []
+    with ProcessPoolExecutor(args.workers) as e:
+        jobs = {e.submit(run, name, outdir, cache): name for name in todo}
+        for f in as_completed(jobs):
+            name = jobs[f]
+            try: t = f.result()
+            except Exception as x:
+                print('%-8s failed: %r' % (name, x))
+                failed.append(name)
+                continue
+            print('%-8s computed in %.1f s' % (name, t))
+            done[name] = todo[name]
+            with open(manifest, 'w') as f: json.dump(done, f, indent=1)
+
+    if failed: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
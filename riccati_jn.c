@@ -13,4 +13,82 @@ void riccati_jn(double *psi, int n, double x)
     psi[1] = psi[0]/x - cos(x);
     for(i=2; i<=n; i++)// upward recurrence
         psi[i] = (2*i-1)*psi[i-1]/x - psi[i-2];
-}
\ No newline at end of file
+}
+
+static void riccati_bessel1(double *psi, double *dpsi,
+                            double *chi, double *dchi, int n, double x)
+// same as riccati_bessel() but for scalar x
+{
+    int i,k,N;
+    double p,q,r,s,c,t0,t1;
+    s = sin(x);
+    c = cos(x);
+    if(n <= x) {// upward recurrence is stable
+        riccati_jn(psi, n, x);
+    }
+    else {// Miller's downward recurrence
+        N = n + 16 + (int)(8*cbrt(n));
+        q = 0;
+        p = 1;
+        for(i=N; i>0; i--) {
+            r = (2*i+1)*p/x - q;// psi[i-1]
+            q = p;
+            p = r;
+            if(i-1 <= n) psi[i-1] = p;
+            if(fabs(p) > 1e250) {// rescale to avoid overflow
+                p *= 1e-250;
+                q *= 1e-250;
+                for(k=i-1; k<=n; k++) psi[k] *= 1e-250;
+            }
+        }
+        // normalize by psi_0 and psi_1 (least squares)
+        t0 = s;
+        t1 = s/x - c;
+        r = (t0*psi[0] + t1*psi[1])/(psi[0]*psi[0] + psi[1]*psi[1]);
+        for(i=0; i<=n; i++) psi[i] *= r;
+    }
+    chi[0] = -c;
+    if(n>0) chi[1] = -c/x - s;
+    for(i=2; i<=n; i++)// upward recurrence
+        chi[i] = (2*i-1)*chi[i-1]/x - chi[i-2];
+
+    dpsi[0] = c;
+    dchi[0] = s;
+    for(i=1; i<=n; i++) {
+        dpsi[i] = psi[i-1] - i*psi[i]/x;
+        dchi[i] = chi[i-1] - i*chi[i]/x;
+    }
+}
+
+void riccati_bessel(double *psi, double *dpsi, double *chi, double *dchi,
+                    int n, const double *x, int nx)
+// riccati-bessel functions psi_n(x) = x j_n(x) and chi_n(x) = x y_n(x)
+// and their derivatives for many x at once
+// input: n, x: 1d-array (length nx)
+// output: psi,dpsi,chi,dchi: 2d-array (nx rows of length n+1)
+//   psi_k(x[i]) is stored in psi[i*(n+1) + k] for k=0,1,...,n
+// psi_n is computed by Miller's downward recurrence if n > x
+// assume output arrays are allocated by caller
+{
+    int i,m=n+1;
+    for(i=0; i<nx; i++)
+        riccati_bessel1(psi + i*m, dpsi + i*m, chi + i*m, dchi + i*m, n, x[i]);
+}
+
+void log_derivative(double *D, int n, double y)
+// logarithmic derivative D_n(y) = psi_n'(y)/psi_n(y)
+// by downward recurrence (Bohren and Huffman eq(4.89))
+// input: n,y
+// output: D: 1d-array (length n+1)
+//   D_n(y) for n=0,1,...,n
+// assume D is allocated by caller
+{
+    int i,N;
+    double d=0;
+    N = (n > y ? n : (int)y);
+    N += 16 + (int)(8*cbrt(N));
+    for(i=N; i>n; i--) d = i/y - 1/(d + i/y);
+    D[n] = d;
+    for(i=n; i>0; i--)
+        D[i-1] = i/y - 1/(D[i] + i/y);
+}
@@ -1,8 +1,12 @@
 import numpy as np
 import ctypes as ct
+from Counters import clock, record
 
 j = ct.cdll.LoadLibrary('libriccati_jn.so')
 j.riccati_jn.argtypes = (ct.POINTER(ct.c_double), ct.c_int, ct.c_double)
+j.riccati_bessel.argtypes = ((ct.POINTER(ct.c_double),)*4 +
+                             (ct.c_int, ct.POINTER(ct.c_double), ct.c_int))
+j.log_derivative.argtypes = (ct.POINTER(ct.c_double), ct.c_int, ct.c_double)
 
 def riccati_jn(n,x):
     """ riccati-bessel function psi_n(x) of first kind
@@ -17,9 +21,54 @@ def riccati_jn(n,x):
     comment: this program was written because
       scipy.special.riccati_jn dosen' work when x > 4400.
     """
+    t0 = clock()
     psi = np.empty(n+1)
     psi_p = psi.ctypes.data_as(ct.POINTER(ct.c_double))
     j.riccati_jn(psi_p, n, x)
     dpsi = psi[:-1] - np.arange(1,n+1)*psi[1:]/x
     dpsi = np.r_[psi[0]/x - psi[1], dpsi]
+    record('riccati_jn', t0, n+1)
     return psi,dpsi
+
+def riccati_bessel(n, x, out=None):
+    """ riccati-bessel functions psi_n(x) = x j_n(x) and
+    chi_n(x) = x y_n(x) and their derivatives for many x at once
+    n: int, scalar
+    x: float, scalar or 1d-array
+    out: tuple of four float arrays, optional
+      buffers for psi,dpsi,chi,dchi, each C-contiguous
+      of shape x.shape + (n+1,)
+    return: psi, dpsi, chi, dchi
+      psi,dpsi,chi,dchi: float, shape x.shape + (n+1,)
+        psi_k(x), (d/dx)psi_k(x), chi_k(x), (d/dx)chi_k(x)
+        for k=0,1,...,n.  psi is computed by Miller's
+        downward recurrence if n > x (stable for n > x).
+        chi is same as scipy.special.riccati_yn.
+    """
+    t0 = clock()
+    shape = np.shape(x) + (n+1,)
+    x = np.ascontiguousarray(x, dtype=float)
+    if out is None: out = [np.empty(shape) for _ in range(4)]
+    for a in out:
+        if(a.shape != shape or a.dtype != np.float64 or
+           not a.flags['C_CONTIGUOUS']):
+            raise RuntimeError('bad buffer')
+    p = [a.ctypes.data_as(ct.POINTER(ct.c_double)) for a in out]
+    j.riccati_bessel(*p, n, x.ctypes.data_as(ct.POINTER(ct.c_double)), x.size)
+    record('riccati_bessel', t0, x.size*(n+1))
+    return tuple(out)
+
+def log_derivative(n,y):
+    """ logarithmic derivative D_n(y) = (d/dy)psi_n(y)/psi_n(y)
+    by downward recurrence (Bohren and Huffman eq(4.89))
+    n: int, scalar
+    y: float, scalar
+    return: D
+      D: float, 1d-array (length n+1)
+        D_n(y) for n=0,1,...,n
+    """
+    t0 = clock()
+    D = np.empty(n+1)
+    j.log_derivative(D.ctypes.data_as(ct.POINTER(ct.c_double)), n, y)
+    record('log_derivative', t0, n+1)
+    return D